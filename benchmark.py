@@ -0,0 +1,922 @@
+#!/usr/bin/python
+
+# Repeatable performance measurements for Cender.
+#
+#   ./benchmark.py stream
+#   ./benchmark.py stream --baud 38400 115200 --flow-control rtscts xonxoff
+#   ./benchmark.py lexer --lines 1000000
+#   ./benchmark.py parse
+#   ./benchmark.py patterns
+#   ./benchmark.py preprocess --processes 1 2 4
+#   ./benchmark.py minimize --baud 38400 115200
+#   ./benchmark.py stream --shape surfacing --minimize
+#
+# Every stream run happens in a child process of its own, so peak RSS is per
+# run and pubsub subscriptions of one controller never leak into the next.
+# Results are written as JSON tagged with the git commit they were taken on.
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import shutil
+import logging
+import platform
+import argparse
+import resource
+import tempfile
+import itertools
+import subprocess
+import multiprocessing
+import gcode
+import patterns
+
+repository_directory = os.path.dirname(os.path.realpath(__file__))
+
+file_shapes = ['rapids', 'surfacing', 'arcs']
+streaming_modes = ['counting', 'interval']
+flow_control_modes = ['rtscts', 'xonxoff', 'none']
+
+
+# reference files
+def rapids_lines(count):
+    # long traverses, the planner is the bottleneck rather than the link
+    lines = ['(benchmark rapids)', 'G21 G90']
+    for index in range(max(10, count // 20)):
+        lines.append('G0 X%.3f Y%.3f' % (40.0 * (index % 2), index * 0.5))
+
+    return lines
+
+
+def surfacing_lines(count):
+    # dense 3D raster, lots of tiny moves each shorter than a planner slot
+    lines = ['(benchmark surfacing)', 'G21 G90', 'G1 F2000']
+    step = 0.25
+    row_length = 200
+    for index in range(count):
+        row, column = divmod(index, row_length)
+        if row % 2 == 1:
+            column = row_length - 1 - column
+        x = column * step
+        y = row * step * 4
+        z = 1.5 * math.sin(x / 5.0) * math.cos(y / 5.0) - 2.0
+        lines.append('G1 X%.4f Y%.4f Z%.4f' % (x, y, z))
+
+    return lines
+
+
+def arcs_lines(count):
+    # chains of small half circles that the board has to segment
+    lines = ['(benchmark arcs)', 'G21 G90 G17', 'G0 X0 Y0', 'G1 F3000']
+    radius = 0.25
+    for index in range(count):
+        command = 'G2' if index % 2 == 0 else 'G3'
+        lines.append('%s X%.4f Y0 I%.4f J0' % (
+            command, (index + 1) * radius * 2, radius))
+
+    return lines
+
+
+def write_reference_file(directory, shape, count):
+    file_path = os.path.join(directory, shape + '.gcode')
+    with open(file_path, 'w') as f:
+        f.write('\n'.join(shape_generators[shape](count)) + '\n')
+
+    return file_path
+
+
+shape_generators = {
+    'rapids': rapids_lines,
+    'surfacing': surfacing_lines,
+    'arcs': arcs_lines}
+
+
+def mixed_lines(count):
+    # a machining program touching everything parse_request looks for
+    lines = ['(benchmark program)', 'G21 G90 G17', 'M3 S12000', 'M8']
+    for index, line in enumerate(surfacing_lines(count)[3:]):
+        if index % 10 == 5:
+            line = 'G2 X%.4f Y%.4f I0.2500 J0' % (index * 0.01, index * 0.02)
+        lines.append(line)
+
+        if index % 500 == 499:
+            lines += ['M5', 'M9', 'G91', 'G0 Z5', 'G90', 'M4 S8000', 'M7',
+                      'G1 F1200']
+
+    return lines + ['M5', 'M9', 'M2']
+
+
+def best_time(function, lines, repeat):
+    # fastest of several runs over a fresh iterable of lines from lines(),
+    # the other runs are mostly noise from the host
+    times = []
+    for run in range(repeat):
+        source = lines()
+        start = time.time()
+        result = function(source)
+        times.append(time.time() - start)
+
+    return min(times), result
+
+
+class HeadlessWindow(object):
+    # the part of MainWindow the drivers call outside of the ui widgets
+
+    def set_comm_status(self, status_text):
+        logging.getLogger(__name__).debug('Comm status: ' + status_text)
+
+
+def isolate_configuration():
+    # configuration writes current.conf in the working directory, move
+    # somewhere disposable before it is first imported
+    work_directory = tempfile.mkdtemp(prefix='cender-benchmark-')
+    os.chdir(work_directory)
+
+    sys.path.insert(0, repository_directory)
+    sys.path.insert(0, os.path.join(repository_directory, 'drivers', 'tinyg'))
+
+    return work_directory
+
+
+def write_mixed_file(count):
+    file_descriptor, file_path = tempfile.mkstemp(suffix='.gcode')
+    with os.fdopen(file_descriptor, 'w') as f:
+        lines = mixed_lines(count)
+        f.write('\n'.join(lines) + '\n')
+
+    return file_path, len(lines)
+
+
+# lexer benchmark
+legacy_request_patterns = [
+    r'F([\d\.]+)', r'^M[78]', r'^M9', r'^M([34])', r'^(?:M[34] )?S(\d+)',
+    r'^M5', r'^G(\d+)(.*)', r'^(G9[01])']
+
+
+def legacy_scan(lines):
+    # the searches the sender made to count a line and parse_request made
+    # when it was sent, before both used the lexer
+    slots = 0
+    for line in lines:
+        if re.search(r'^(?:M|G|T|S|F)(\d+)', line) is not None:
+            slots += 1
+            if re.search(r'^G0?[23]', line) is not None:
+                slots += 3
+
+        for pattern in legacy_request_patterns:
+            re.search(pattern, line)
+
+    return slots
+
+
+def lexer_scan(lines):
+    # the same work through the lexer, tokenized once when counting and
+    # once more when the line is sent
+    slots = 0
+    for line in lines:
+        tokens = gcode.tokenize(line)
+        if len(tokens) > 0 and tokens[0][0] in 'MGTSF' and \
+                len(tokens[0][1]) > 0:
+            g_codes = gcode.codes(tokens, 'G')
+            slots += 4 if (2 in g_codes or 3 in g_codes) else 1
+
+        tokens = gcode.tokenize(line)
+        m_codes = gcode.codes(tokens, 'M')
+        for word, value in tokens:
+            if word == 'F':
+                break
+        gcode.codes(tokens, 'S')
+        gcode.codes(tokens, 'G')
+
+    return slots
+
+
+def lexer(options):
+    file_path, lines = write_mixed_file(options.lines)
+    sys.stderr.write('scanning ' + str(lines) + ' lines\n')
+
+    def read():
+        return gcode.read_lines(file_path)
+
+    try:
+        legacy_time, legacy_slots = best_time(
+            legacy_scan, read, options.repeat)
+        lexer_time, lexer_slots = best_time(lexer_scan, read, options.repeat)
+    finally:
+        os.remove(file_path)
+
+    result = {
+        'lines': lines,
+        'legacy_seconds': legacy_time,
+        'lexer_seconds': lexer_time,
+        'legacy_lines_per_second': lines / legacy_time,
+        'lexer_lines_per_second': lines / lexer_time,
+        'speedup': legacy_time / lexer_time,
+        'legacy_slots': legacy_slots,
+        'lexer_slots': lexer_slots}
+
+    sys.stderr.write(
+        '  regexes %.0f lines/s, lexer %.0f lines/s, %.2fx\n' % (
+            result['legacy_lines_per_second'],
+            result['lexer_lines_per_second'], result['speedup']))
+
+    return [result]
+
+
+# response parsing benchmark
+parse_sample_responses = [
+    ('{"r":{},"f":[1,0,22,0]}', 40),
+    ('{"qr":12,"qi":1,"qo":1}', 30),
+    ('{"sr":{"posx":1.234,"posy":2.345,"posz":-1.0,"vel":1500,"stat":5}}',
+     20),
+    ('', 8),
+    ('{"r":{"msg":"_SESSION_benchmark"},"f":[1,0,30,0]}', 1),
+    ('[xvm] x velocity maximum      16000.000 mm/min', 1)]
+
+
+def legacy_parse_response(controller, line):
+    # TinyG.parse_response as it was before the dispatch table, every
+    # parser and the config patterns tried on every line
+    log = True
+    try:
+        response = json.loads(line)
+        if isinstance(response, dict):
+            if 'r' in response:
+                response = response['r']
+            if len(response) == 0 or 'rx' in response or '' in response:
+                log = False
+            log = controller.parse_reset(response) and log
+            log = controller.parse_queue_report(response) and log
+            log = controller.parse_position(response) and log
+            log = controller.parse_errors(response) and log
+            log = controller.parse_status(response) and log
+            log = controller.parse_echo(response) and log
+    except ValueError:
+        pass
+
+    return controller.parse_config(line) and log
+
+
+def parse(options):
+    original_directory = os.getcwd()
+    work_directory = isolate_configuration()
+
+    try:
+        from tinyg097 import TinyG097
+        controller = TinyG097(HeadlessWindow())
+
+        sample = []
+        for line, weight in parse_sample_responses:
+            sample += [line.replace('SESSION', controller.session_id)] * weight
+        lines = (sample * (options.lines // len(sample) + 1))[:options.lines]
+
+        def legacy(lines):
+            for line in lines:
+                legacy_parse_response(controller, line)
+
+        def dispatch(lines):
+            for line in lines:
+                controller.parse_response(line)
+
+        legacy_time = best_time(legacy, lambda: lines, options.repeat)[0]
+        dispatch_time = best_time(dispatch, lambda: lines, options.repeat)[0]
+    finally:
+        os.chdir(original_directory)
+        shutil.rmtree(work_directory, True)
+
+    result = {
+        'lines': len(lines),
+        'legacy_microseconds_per_line': legacy_time / len(lines) * 1e6,
+        'dispatch_microseconds_per_line': dispatch_time / len(lines) * 1e6,
+        'speedup': legacy_time / dispatch_time}
+
+    sys.stderr.write(
+        '  every parser %.1fus/line, dispatched %.1fus/line, %.2fx\n' % (
+            result['legacy_microseconds_per_line'],
+            result['dispatch_microseconds_per_line'], result['speedup']))
+
+    return [result]
+
+
+# pattern registry benchmark
+pattern_session_id = 'benchmark0session0id'
+
+pattern_sample_lines = [
+    (True, 'G1 X1.0000 Y2.0000 Z-1.0000', 50),
+    (False, 'tinyg [mm] ok>', 30),
+    (False, '{"sr":{"posx":1.234,"posy":2.345,"vel":1500,"stat":5}}', 10),
+    (False, '{"r":{"msg":"_' + pattern_session_id + '_end-of-file"},'
+     '"f":[1,0,30,0]}', 1),
+    (False, '[xvm] x velocity maximum      16000.000 mm/min', 1)]
+
+
+def legacy_pattern_scan(lines):
+    # the pattern work on each line sent and received, compiling or looking
+    # up the pattern on every call the way the drivers used to
+    for sent, line in lines:
+        if sent:
+            re.search(re.compile('_' + pattern_session_id + '_'), line)
+            continue
+
+        re.search(r'^tinyg \[[^\]]+\] (ok|err)', line)
+        line = re.sub(r"^tinyg \[[^\]]+\] ok\>\s*", "", line)
+        if line.startswith('{') and '"msg"' in line:
+            session_re = re.compile('_' + pattern_session_id + '_')
+            if re.search(session_re, line) is not None:
+                re.sub(session_re, '', line)
+        elif line.startswith('['):
+            for pattern in [
+                    '([\d\.\-\w]+)(.{0})',
+                    '([\d+\.]+) (?:\[)([^\]]+)(?:\])',
+                    '([\d+\.]+) (\w+\/\w+(?:\^\d))',
+                    '([\d\-\.]+) (\w{2,3}).*']:
+                config_re = re.compile(
+                    '^\[([^\]]+)\] +([\w ]{0,10}[a-zA-Z ]+) ' + pattern +
+                    '$')
+                if re.search(config_re, line) is not None:
+                    break
+
+
+def registry_pattern_scan(lines):
+    session_pattern = patterns.session(pattern_session_id)
+    for sent, line in lines:
+        if sent:
+            session_pattern.search(line)
+            continue
+
+        patterns.tinyg_acknowledgement.search(line)
+        line = patterns.tinyg_prompt.sub('', line)
+        if line.startswith('{') and '"msg"' in line:
+            if session_pattern.search(line) is not None:
+                session_pattern.sub('', line)
+        elif line.startswith('['):
+            for config_pattern in patterns.tinyg_config:
+                if config_pattern.search(line) is not None:
+                    break
+
+
+def pattern_registry(options):
+    sample = []
+    for sent, line, weight in pattern_sample_lines:
+        sample += [(sent, line)] * weight
+    lines = (sample * (options.lines // len(sample) + 1))[:options.lines]
+
+    legacy_time = best_time(
+        legacy_pattern_scan, lambda: lines, options.repeat)[0]
+    registry_time = best_time(
+        registry_pattern_scan, lambda: lines, options.repeat)[0]
+
+    result = {
+        'lines': len(lines),
+        'legacy_microseconds_per_line': legacy_time / len(lines) * 1e6,
+        'registry_microseconds_per_line': registry_time / len(lines) * 1e6,
+        'speedup': legacy_time / registry_time}
+
+    sys.stderr.write(
+        '  compiled per call %.2fus/line, registry %.2fus/line, %.2fx\n' % (
+            result['legacy_microseconds_per_line'],
+            result['registry_microseconds_per_line'], result['speedup']))
+
+    return [result]
+
+
+# preprocess benchmark
+def default_process_counts():
+    counts = [1]
+    while counts[-1] * 2 <= multiprocessing.cpu_count():
+        counts.append(counts[-1] * 2)
+
+    return counts
+
+
+def preprocess_files(options):
+    original_directory = os.getcwd()
+    work_directory = isolate_configuration()
+    file_path, line_count = write_mixed_file(options.lines)
+
+    # the pools are forked before the controller starts its threads, the
+    # same as the application does
+    pools = dict(
+        (processes, multiprocessing.Pool(processes))
+        for processes in options.processes)
+    try:
+        import preflight
+        import preprocess
+        from tinyg097 import TinyG097
+        controller = TinyG097(HeadlessWindow())
+        settings = preprocess.ChunkSettings(controller)
+
+        def serial():
+            rewriter = gcode.NumberRewriter(controller.word_decimals)
+            commands = list(controller.process_lines(
+                gcode.read_lines(file_path), rewriter))
+            analysis = preflight.analyse(
+                commands, controller.command_slots,
+                controller.arc_slot_counter())
+            analysis.bytes_saved = rewriter.bytes_saved
+            return commands, analysis
+
+        def parallel(processes):
+            directory = tempfile.mkdtemp(dir=work_directory)
+            analysis, commands_paths = preprocess.preprocess(
+                pools[processes], settings, file_path, processes,
+                directory)
+            commands = []
+            for commands_path in commands_paths:
+                commands += list(gcode.read_lines(commands_path))
+            shutil.rmtree(directory)
+            return commands, analysis
+
+        serial_time, (serial_commands, serial_analysis) = best_time(
+            lambda source: serial(), lambda: None, options.repeat)
+
+        results = []
+        sys.stderr.write('  serial %.2fs for %d lines\n' % (
+            serial_time, line_count))
+        for processes in options.processes:
+            parallel_time, (commands, analysis) = best_time(
+                lambda source: parallel(processes), lambda: None,
+                options.repeat)
+
+            # the chunked result has to be the serial one exactly
+            identical = commands == serial_commands and \
+                analysis.__dict__ == serial_analysis.__dict__
+            result = {
+                'lines': line_count,
+                'cores': multiprocessing.cpu_count(),
+                'processes': processes,
+                'serial_seconds': serial_time,
+                'parallel_seconds': parallel_time,
+                'speedup': serial_time / parallel_time,
+                'identical': identical}
+            results.append(result)
+
+            sys.stderr.write(
+                '  %d processes %.2fs, %.2fx%s\n' % (
+                    processes, parallel_time, result['speedup'],
+                    '' if identical else ', DIFFERENT from serial'))
+    finally:
+        for pool in pools.values():
+            pool.terminate()
+        os.remove(file_path)
+        os.chdir(original_directory)
+        shutil.rmtree(work_directory, True)
+
+    return results
+
+
+# minimize benchmark
+def cam_lines(count):
+    # the surfacing raster the way most cam post processors write it, the
+    # motion word and feed rate on every line and words padded with spaces
+    lines = ['(benchmark cam output)', 'G90 G94 G17', 'G21']
+    for line in surfacing_lines(count)[3:]:
+        lines.append(line.replace('G1 ', 'G01 ') + ' F2000.')
+
+    return lines
+
+
+def minimize_commands(options):
+    generators = dict(shape_generators)
+    generators['mixed'] = mixed_lines
+    generators['cam'] = cam_lines
+
+    results = []
+    for shape in options.shape:
+        # what is sent with the default filtering and precision, before
+        # and after minimizing
+        rewriter = gcode.NumberRewriter()
+        commands = [
+            rewriter.rewrite(line.strip())
+            for line in gcode.filter_lines(generators[shape](options.lines))]
+        commands = [command for command in commands if len(command) > 0]
+
+        minimize_time, minimized = best_time(
+            lambda source: list(gcode.minimize_lines(source)),
+            lambda: commands, options.repeat)
+
+        # every line goes out with a newline after it
+        before = sum(len(command) + 1 for command in commands)
+        after = sum(len(command) + 1 for command in minimized)
+        result = {
+            'shape': shape,
+            'lines': len(commands),
+            'minimized_lines': len(minimized),
+            'bytes_per_line': float(before) / len(commands),
+            'minimized_bytes_per_line': float(after) / len(commands),
+            'saved': 1.0 - float(after) / before,
+            'microseconds_per_line': minimize_time / len(commands) * 1e6,
+            'lines_per_second': {},
+            'minimized_lines_per_second': {}}
+
+        sys.stderr.write(
+            '  %s %.1f bytes/line, minimized %.1f bytes/line, %.1f%% '
+            'saved, %.2fus/line\n' % (
+                shape, result['bytes_per_line'],
+                result['minimized_bytes_per_line'], result['saved'] * 100,
+                result['microseconds_per_line']))
+
+        # lines the link alone can carry each second, a byte takes ten bits
+        # with the start and stop bits
+        for baud in options.baud:
+            lines_per_second = baud / 10.0 / result['bytes_per_line']
+            minimized_lines_per_second = \
+                baud / 10.0 / result['minimized_bytes_per_line']
+            result['lines_per_second'][str(baud)] = lines_per_second
+            result['minimized_lines_per_second'][str(baud)] = \
+                minimized_lines_per_second
+            sys.stderr.write(
+                '    @ %d %.0f lines/s, minimized %.0f lines/s\n' % (
+                    baud, lines_per_second, minimized_lines_per_second))
+
+        results.append(result)
+
+    return results
+
+
+# stream benchmark
+class StreamRun(object):
+
+    def __init__(self, app, simulator):
+        self.app = app
+        self.simulator = simulator
+        self.config_fetched = False
+        self.finished = False
+        self.hold_requested = None
+        self.hold_confirmed = None
+
+    def config_fetched_handler(self):
+        self.config_fetched = True
+
+    def end_of_file_handler(self):
+        self.finished = True
+
+    def line_received_handler(self, line, log):
+        if self.hold_requested is not None and \
+                self.hold_confirmed is None and '"stat":6' in line:
+            self.hold_confirmed = time.time()
+
+    def wait_for(self, condition, timeout):
+        # keep the event loop turning, the drivers hand everything the
+        # listener and sender threads produce to the main thread
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                return False
+            self.app.processEvents()
+            time.sleep(0.001)
+
+        return True
+
+
+def run_stream(options):
+    original_directory = os.getcwd()
+    work_directory = isolate_configuration()
+
+    import serial
+    from PyQt4 import QtCore
+    from pubsub import pub
+    from configuration import conf
+    from tinyg_simulator import TinyGSimulator
+    from tinyg096 import TinyG096
+    from tinyg097 import TinyG097
+
+    if options.file is not None:
+        file_path = os.path.realpath(options.file)
+    else:
+        file_path = write_reference_file(
+            work_directory, options.shape, options.lines)
+
+    conf.set('connection.port.baud', options.baud)
+    conf.set('connection.port.flow_control', options.flow_control)
+    conf.set('connection.character_counting',
+             options.streaming == 'counting')
+    conf.set('common.minimize_file_commands', options.minimize)
+
+    app = QtCore.QCoreApplication(sys.argv[:1])
+
+    simulator = TinyGSimulator(
+        version=options.version, baud=options.baud, speed=options.speed)
+    simulator.start()
+
+    run = StreamRun(app, simulator)
+    pub.subscribe(run.config_fetched_handler, 'config-fetched')
+    pub.subscribe(run.end_of_file_handler, 'end-of-file')
+    pub.subscribe(run.line_received_handler, 'line-received')
+
+    driver_class = TinyG096 if options.version < 0.97 else TinyG097
+    controller = driver_class(HeadlessWindow())
+
+    result = {
+        'file': os.path.basename(file_path),
+        'shape': options.shape,
+        'baud': options.baud,
+        'flow_control': options.flow_control,
+        'streaming': options.streaming,
+        'minimize': options.minimize,
+        'firmware_version': options.version,
+        'speed': options.speed}
+
+    try:
+        # the same session setup connect() performs, without its fixed
+        # ten second wait in the main thread
+        controller.port = serial.Serial(
+            simulator.port_name, options.baud, timeout=0, writeTimeout=0,
+            rtscts=(options.flow_control == 'rtscts'),
+            xonxoff=(options.flow_control == 'xonxoff'))
+        controller.connected = True
+        controller.enable_flow_control()
+        controller.enable_queue_reports()
+        controller.fetch_board_config()
+        if not run.wait_for(lambda: run.config_fetched, 30):
+            raise Exception('board configuration was never received')
+
+        with open(file_path) as f:
+            file_lines = sum(1 for line in f)
+
+        start = simulator.statistics()
+        start_time = time.time()
+        controller.send_file(file_path)
+
+        def hold_point():
+            received = simulator.statistics()['lines_received']
+            return (received - start['lines_received']) * 2 >= file_lines
+
+        hold_time = 0.0
+        if options.feed_hold and run.wait_for(hold_point, options.timeout):
+            run.hold_requested = time.time()
+            controller.pause()
+            run.wait_for(lambda: run.hold_confirmed is not None, 10)
+            controller.resume()
+            hold_time = time.time() - run.hold_requested
+
+        if not run.wait_for(lambda: run.finished, options.timeout):
+            raise Exception('end of file was never reported')
+        run.wait_for(lambda: simulator.statistics()['idle'], options.timeout)
+        end_time = time.time()
+        end = simulator.statistics()
+
+        if end['last_motion_time'] is not None:
+            end_time = max(end_time, end['last_motion_time'])
+        duration = max(end_time - start_time - hold_time, 1e-6)
+        lines = end['lines_received'] - start['lines_received']
+        data = end['bytes_received'] - start['bytes_received']
+
+        result['lines'] = lines
+        result['bytes'] = data
+        result['duration'] = duration
+        result['lines_per_second'] = lines / duration
+        result['bytes_per_second'] = data / duration
+        result['bytes_per_line'] = float(data) / max(lines, 1)
+        result['starvation_time'] = \
+            end['starved_time'] - start['starved_time']
+        result['moves_executed'] = \
+            end['moves_executed'] - start['moves_executed']
+        if end['first_motion_time'] is not None:
+            result['time_to_first_motion'] = \
+                end['first_motion_time'] - start_time
+        if run.hold_confirmed is not None:
+            result['feed_hold_latency'] = \
+                run.hold_confirmed - run.hold_requested
+        if controller.sender_thread is not None:
+            result['sender_blocked_time'] = \
+                controller.sender_thread.blocked_time
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        if controller.listener_thread is not None:
+            controller.listener_thread.exit()
+            controller.listener_thread.wait(2000)
+        if controller.port is not None:
+            controller.port.close()
+        simulator.close()
+
+        os.chdir(original_directory)
+        shutil.rmtree(work_directory, True)
+
+    # kilobytes on linux
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return result
+
+
+def stream_child_arguments(options, baud, flow_control, streaming, shape):
+    arguments = [
+        sys.executable, os.path.realpath(__file__), 'stream', '--child',
+        '--baud', str(baud),
+        '--flow-control', flow_control,
+        '--streaming', streaming,
+        '--version', str(options.version),
+        '--speed', str(options.speed),
+        '--lines', str(options.lines),
+        '--timeout', str(options.timeout)]
+    if shape is not None:
+        arguments += ['--shape', shape]
+    else:
+        arguments.append('--shape')
+    if not options.feed_hold:
+        arguments.append('--no-feed-hold')
+    if options.minimize:
+        arguments.append('--minimize')
+
+    return arguments
+
+
+def stream(options):
+    if options.child:
+        options.baud = options.baud[0]
+        options.flow_control = options.flow_control[0]
+        options.streaming = options.streaming[0]
+        options.shape = None
+        options.file = None
+        if options.files:
+            options.file = options.files[0]
+        elif options.shape:
+            options.shape = options.shape[0]
+        print(json.dumps(run_stream(options)))
+        return []
+
+    sources = [(shape, None) for shape in options.shape]
+    sources += [(None, file_path) for file_path in options.files]
+
+    results = []
+    for baud, flow_control, streaming, (shape, file_path) in \
+            itertools.product(options.baud, options.flow_control,
+                              options.streaming, sources):
+        arguments = stream_child_arguments(
+            options, baud, flow_control, streaming, shape)
+        if file_path is not None:
+            arguments += ['--files', os.path.realpath(file_path)]
+
+        label = '%s @ %d, %s, %s%s' % (
+            shape or os.path.basename(file_path), baud, flow_control,
+            streaming, ', minimized' if options.minimize else '')
+        sys.stderr.write(label + '\n')
+
+        child = subprocess.Popen(arguments, stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        try:
+            result = json.loads(output.decode('utf-8').splitlines()[-1])
+        except (ValueError, IndexError):
+            result = {'error': 'run failed with exit code ' +
+                      str(child.returncode)}
+        result['label'] = label
+        results.append(result)
+
+        if 'error' in result:
+            sys.stderr.write('  error: ' + result['error'] + '\n')
+        else:
+            sys.stderr.write(
+                '  %.0f lines/s, %.0f bytes/s, %.1f bytes/line, '
+                '%.3fs starved, %.3fs to first motion, %s hold latency, '
+                '%d KB peak\n' % (
+                    result['lines_per_second'], result['bytes_per_second'],
+                    result['bytes_per_line'],
+                    result['starvation_time'],
+                    result.get('time_to_first_motion', float('nan')),
+                    '%.3fs' % result['feed_hold_latency']
+                    if 'feed_hold_latency' in result else 'no',
+                    result['peak_rss_kb']))
+
+    return results
+
+
+# reporting
+def git_revision():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=repository_directory).decode('utf-8').strip()
+        changes = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=repository_directory).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit, len(changes) > 0
+
+
+def write_report(options, results):
+    commit, modified = git_revision()
+    report = {
+        'benchmark': options.benchmark,
+        'commit': commit,
+        'modified': modified,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results}
+
+    output = options.output
+    if output is None:
+        output = 'benchmark-' + options.benchmark + '-' + \
+            (commit[:10] if commit is not None else 'unknown') + '.json'
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    sys.stderr.write('results written to ' + output + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Cender performance benchmarks')
+    parser.add_argument(
+        '--output', help='json results file, named after the commit '
+        'when not given')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    stream_parser = subparsers.add_parser(
+        'stream', help='stream g-code to the simulated TinyG through '
+        'ControllerBoard.send_file')
+    stream_parser.add_argument(
+        '--baud', type=int, nargs='+', default=[115200])
+    stream_parser.add_argument(
+        '--flow-control', nargs='+', default=['rtscts'],
+        choices=flow_control_modes)
+    stream_parser.add_argument(
+        '--streaming', nargs='+', default=['counting'],
+        choices=streaming_modes,
+        help='character counting or the original status interval sender')
+    stream_parser.add_argument(
+        '--shape', nargs='*', default=file_shapes, choices=file_shapes,
+        help='generated reference files to stream')
+    stream_parser.add_argument(
+        '--files', nargs='*', default=[],
+        help='g-code files to stream as well as the generated ones')
+    stream_parser.add_argument(
+        '--lines', type=int, default=2000,
+        help='moves per generated file, rapids use a twentieth of this')
+    stream_parser.add_argument('--version', type=float, default=0.97)
+    stream_parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='simulator execution speed multiplier, 0 is instant')
+    stream_parser.add_argument(
+        '--no-feed-hold', dest='feed_hold', action='store_false',
+        help='skip the feed hold half way through each file')
+    stream_parser.add_argument('--timeout', type=float, default=600)
+    stream_parser.add_argument(
+        '--minimize', action='store_true',
+        help='drop repeated modal words from the file as it is sent')
+    stream_parser.add_argument(
+        '--child', action='store_true', help=argparse.SUPPRESS)
+
+    lexer_parser = subparsers.add_parser(
+        'lexer', help='count and parse request lines with the lexer against '
+        'the per line regexes it replaced')
+    lexer_parser.add_argument('--lines', type=int, default=1000000)
+    lexer_parser.add_argument('--repeat', type=int, default=3)
+
+    parse_parser = subparsers.add_parser(
+        'parse', help='per line cost of TinyG.parse_response on a sample of '
+        'streaming responses, against calling every parser on every line')
+    parse_parser.add_argument('--lines', type=int, default=200000)
+    parse_parser.add_argument('--repeat', type=int, default=3)
+
+    patterns_parser = subparsers.add_parser(
+        'patterns', help='per line cost of the shared compiled patterns '
+        'against compiling them on every call')
+    patterns_parser.add_argument('--lines', type=int, default=500000)
+    patterns_parser.add_argument('--repeat', type=int, default=3)
+
+    preprocess_parser = subparsers.add_parser(
+        'preprocess', help='preflight of a large file split over a pool of '
+        'processes against the single pass, for each number of processes')
+    preprocess_parser.add_argument('--lines', type=int, default=500000)
+    preprocess_parser.add_argument(
+        '--processes', type=int, nargs='+', default=default_process_counts())
+    preprocess_parser.add_argument('--repeat', type=int, default=3)
+
+    minimize_parser = subparsers.add_parser(
+        'minimize', help='bytes per line sent and the lines per second the '
+        'link can carry, before and after dropping repeated modal words')
+    minimize_parser.add_argument(
+        '--shape', nargs='+', default=file_shapes + ['mixed', 'cam'],
+        choices=file_shapes + ['mixed', 'cam'])
+    minimize_parser.add_argument(
+        '--baud', type=int, nargs='+', default=[115200])
+    minimize_parser.add_argument('--lines', type=int, default=200000)
+    minimize_parser.add_argument('--repeat', type=int, default=3)
+
+    options = parser.parse_args()
+
+    if options.benchmark == 'stream':
+        results = stream(options)
+        if options.child:
+            return
+    elif options.benchmark == 'lexer':
+        results = lexer(options)
+    elif options.benchmark == 'parse':
+        results = parse(options)
+    elif options.benchmark == 'patterns':
+        results = pattern_registry(options)
+    elif options.benchmark == 'preprocess':
+        results = preprocess_files(options)
+    elif options.benchmark == 'minimize':
+        results = minimize_commands(options)
+
+    write_report(options, results)
+
+if __name__ == '__main__':
+    main()
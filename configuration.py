@@ -1,5 +1,9 @@
 import os.path
+import atexit
+import shutil
 import logging
+import tempfile
+import threading
 import serial
 from configobj import ConfigObj
 import collections
@@ -7,23 +11,30 @@ import collections
 
 class Config():
 
-    boolean_elements = [
-        'common.add_gcode_comments_for_system_commands',
-        'ui.disable_homing',
-        'common.auto_connect',
-        'common.filter_file_commands',
-        'common.restrict_file_precision',
-        'common.check_firmware_version']
     configobj = ConfigObj()
 
+    # seconds to wait after a change before writing the file, any other
+    # changes made in the meantime go out with the same write
+    write_delay = 1.0
+
     def __init__(self):
         self.config_filename = 'current.conf'
         self.logger = logging.getLogger(__name__)
         self.configobj = ConfigObj(self.config_filename)
 
+        # typed values by path, filled as they are asked for and replaced
+        # or dropped when the paths they depend on change
+        self.cache = {}
+        self.defaults = self.flatten(self.generate_default())
+        self.dirty = False
+        self.write_job = None
+        self.lock = threading.RLock()
+        atexit.register(self.flush)
+
         if not os.path.isfile(self.config_filename):
-            self.configobj = self.generate_default()
-            self.configobj.write()
+            self.configobj.merge(self.generate_default())
+            self.dirty = True
+            self.flush()
 
             self.logger.debug('Default configuration loaded')
         else:
@@ -31,7 +42,7 @@ class Config():
                 'Configuration file ' + self.config_filename + ' loaded')
 
     def generate_default(self):
-        default_config = ConfigObj(self.config_filename)
+        default_config = ConfigObj()
         default_config['common'] = {}
         default_config['connection'] = {}
         default_config['connection']['port'] = {}
@@ -47,7 +58,10 @@ class Config():
         default_config['common']['units'] = 0
         default_config['common']['filter_file_commands'] = True
         default_config['common']['restrict_file_precision'] = True
+        default_config['common']['minimize_file_commands'] = False
         default_config['common']['check_firmware_version'] = True
+        default_config['common']['program_cache_directory'] = 'program_cache'
+        default_config['common']['preprocess_processes'] = 0
 
         default_config['connection']['port'] = {}
         default_config['connection']['port']['name'] = "/dev/ttyUSB0"
@@ -57,6 +71,8 @@ class Config():
         default_config['connection']['port']['stopbits'] = serial.STOPBITS_ONE
         default_config['connection']['port']['parity'] = 'None'
         default_config['connection']['port']['flow_control'] = 'rtscts'
+        default_config['connection']['event_driven_listener'] = True
+        default_config['connection']['character_counting'] = True
 
         default_config['ui']['spindle_speed_index'] = 0
         default_config['ui']['jog_step_index'] = 3
@@ -64,6 +80,8 @@ class Config():
         default_config['ui']['spindle_direction'] = 0
         default_config['ui']['disable_homing'] = False
         default_config['ui']['lcd_precision'] = 3
+        default_config['ui']['dro_refresh_rate'] = 20
+        default_config['ui']['console_lines'] = 5000
         default_config['ui']['offset_names'] = [
             'Work Offset 1', 'Work Offset 2', 'Work Offset 3']
         default_config['ui']['current_offset_index'] = 0
@@ -71,16 +89,58 @@ class Config():
 
         return default_config
 
+    def flatten(self, section, prefix=''):
+        # dotted paths to the values of a nested config, empty sections are
+        # kept as values of their own
+        values = {}
+        for key, value in section.items():
+            if isinstance(value, dict) and len(value) > 0:
+                values.update(self.flatten(value, prefix + key + '.'))
+            else:
+                values[prefix + key] = value
+
+        return values
+
+    def convert(self, path, value):
+        # values read back from the file are strings, give them the type of
+        # their default so they look the same before and after a write
+        default = self.defaults.get(path)
+        if value is None or default is None:
+            return value
+
+        if isinstance(default, bool):
+            return value is True or value == 'True'
+
+        if isinstance(default, (int, float, str)):
+            try:
+                return type(default)(value)
+            except (TypeError, ValueError):
+                pass
+
+        return value
+
     def get(self, path):
         # self.logger.debug('Get config item '+ path)
-        value = self.fetch_value_via_path(self.configobj, path)
+        try:
+            return self.cache[path]
+        except KeyError:
+            pass
 
-        # fetch a default config value and merge it with the existing config
-        if value is None:
-            value = self.fetch_value_via_path(self.generate_default(), path)
-            # self.logger.debug('     default to '+ value)
-            if value is not None:
-                self.set(path, value)
+        # a set() on another thread between reading the value and caching
+        # it would leave the old value cached
+        with self.lock:
+            value = self.fetch_value_via_path(self.configobj, path)
+
+            # fetch a default config value and merge it with the existing
+            # config
+            if value is None:
+                value = self.defaults.get(path)
+                # self.logger.debug('     default to '+ value)
+                if value is not None:
+                    self.set(path, value)
+
+            value = self.convert(path, value)
+            self.cache[path] = value
 
         return value
 
@@ -99,13 +159,74 @@ class Config():
 
         return frag
 
+    def forget(self, path):
+        # drop the cached values a change to path makes stale, the path
+        # itself, the sections holding it and anything inside it
+        keys = path.split('.')
+        sections = set(
+            '.'.join(keys[:index]) for index in range(1, len(keys) + 1))
+        for cached in list(self.cache):
+            if cached in sections or cached.startswith(path + '.'):
+                del self.cache[cached]
+
     def set(self, path, value):
         keys = path.split('.')
+        value = self.convert(path, value)
         temp_config = self.build_temp_config_dictionary(keys, value)
 
-        self.configobj.merge(temp_config)
-        self.configobj.write()
-        self.configobj.reload()
+        with self.lock:
+            self.configobj.merge(temp_config)
+            self.forget(path)
+            # a plain value is what get would read back, sections are left
+            # to be fetched again
+            if not isinstance(value, dict):
+                self.cache[path] = value
+            self.dirty = True
+
+            if self.write_job is not None:
+                self.write_job.resume()
+
+    def schedule_writes(self, scheduler):
+        # changes are written by a one shot job on the scheduler, resumed
+        # by the first change after a write, until there is a scheduler
+        # they wait for it or for the write at exit
+        with self.lock:
+            if self.write_job is not None:
+                self.write_job.stop()
+            self.write_job = scheduler.add(
+                self.write_delay, self.flush, paused=not self.dirty,
+                once=True)
+
+    def flush(self):
+        # write the whole config beside the file and rename it over the top,
+        # a crash part way through leaves the previous file intact
+        with self.lock:
+            if not self.dirty:
+                return False
+
+            directory = os.path.dirname(os.path.abspath(self.config_filename))
+            file_descriptor, temp_path = tempfile.mkstemp(
+                prefix='.' + os.path.basename(self.config_filename),
+                dir=directory)
+            try:
+                with os.fdopen(file_descriptor, 'wb') as f:
+                    self.configobj.write(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                # mkstemp creates the file readable by its owner only
+                if os.path.exists(self.config_filename):
+                    shutil.copymode(self.config_filename, temp_path)
+                os.rename(temp_path, self.config_filename)
+            except (IOError, OSError):
+                self.logger.debug(
+                    'Writing ' + self.config_filename + ' failed')
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return False
+
+            self.dirty = False
+
+        return True
 
     def fetch_value_via_path(self, list, path):
         keys = path.split('.')
@@ -116,12 +237,6 @@ class Config():
             else:
                 return None
 
-        try:
-            if self.boolean_elements.index(path) >= 0:
-                current_element = (current_element == 'True')
-        except:
-            pass
-
         return current_element
 
     def save_to_file(self, abs_file_path):
@@ -140,11 +255,13 @@ class Config():
         cwd = os.getcwd()
         os.chdir(os.path.dirname(abs_file_path))
         config_clone = ConfigObj(os.path.basename(abs_file_path))
-        self.configobj.merge(config_clone)
+        with self.lock:
+            self.configobj.merge(config_clone)
+            self.cache.clear()
+            self.dirty = True
         os.chdir(cwd)
 
-        self.configobj.write()
-        self.configobj.reload()
+        self.flush()
 
 
 conf = Config()
@@ -0,0 +1,91 @@
+import shutil
+import logging
+import tempfile
+from collections import deque
+from PyQt4 import QtCore
+
+
+class ConsoleModel(QtCore.QAbstractListModel):
+
+    """
+      the lines sent to and received from the board, only the newest
+      capacity lines are kept for the view while every line also goes to a
+      temporary file so the whole log can still be saved
+    """
+
+    # milliseconds appended lines are collected for before the view is told
+    batch_interval = 33
+
+    def __init__(self, capacity, parent=None):
+        super(ConsoleModel, self).__init__(parent)
+        self.logger = logging.getLogger(__name__)
+        self.capacity = max(1, capacity)
+        self.lines = deque()
+        self.pending = []
+        self.spill = tempfile.TemporaryFile(mode='w+')
+
+        self.batch_timer = QtCore.QTimer(self)
+        self.batch_timer.setSingleShot(True)
+        self.batch_timer.timeout.connect(self.flush)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+
+        return len(self.lines)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole or not index.isValid() or \
+                index.row() >= len(self.lines):
+            return QtCore.QVariant()
+
+        return QtCore.QVariant(self.lines[index.row()])
+
+    def append(self, line):
+        self.pending.append(line)
+        if not self.batch_timer.isActive():
+            self.batch_timer.start(self.batch_interval)
+
+    def flush(self):
+        lines = self.pending
+        self.pending = []
+        if len(lines) == 0:
+            return
+
+        for line in lines:
+            self.spill.write(line + '\n')
+
+        # a batch larger than the whole buffer only keeps its newest lines
+        lines = lines[-self.capacity:]
+        overflow = len(self.lines) + len(lines) - self.capacity
+        if overflow > 0:
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, overflow - 1)
+            for i in range(overflow):
+                self.lines.popleft()
+            self.endRemoveRows()
+
+        self.beginInsertRows(
+            QtCore.QModelIndex(), len(self.lines),
+            len(self.lines) + len(lines) - 1)
+        self.lines.extend(lines)
+        self.endInsertRows()
+
+    def clear(self):
+        self.batch_timer.stop()
+        self.beginResetModel()
+        self.lines.clear()
+        self.pending = []
+        self.spill.seek(0)
+        self.spill.truncate()
+        self.endResetModel()
+
+    def export(self, file_path):
+        # every line since the last clear, not just the ones still shown
+        self.flush()
+        self.spill.flush()
+        self.spill.seek(0)
+        try:
+            with open(file_path, 'w') as f:
+                shutil.copyfileobj(self.spill, f)
+        finally:
+            self.spill.seek(0, 2)
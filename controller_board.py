@@ -1,58 +1,87 @@
 import serial
 import logging
 import time
-import re
 import os
+import select
 import random
 import string
 import threading
+import gcode
+import patterns
+import preflight
+import preprocess
+from machine_state import MachineState
+from position_journal import PositionJournal
+from program_cache import ProgramCache
+from scheduler import Scheduler, monotonic
 from configuration import conf
 from PyQt4 import QtCore
 from pubsub import pub
 
 
 class ControllerBoardListener(QtCore.QThread):
-    line_received = QtCore.pyqtSignal(str)
+    lines_received = QtCore.pyqtSignal(list)
     controller = None
     exit_loop = False
+    wake_pipe = None
+    port_fileno = None
 
     def __init__(self, parent=None):
         QtCore.QThread.__init__(self, parent)
         # super(ControllerBoardListener, self).__init__(parent)
         self.logger = logging.getLogger(__name__)
 
+        # exit() and close_wake_pipe() run on different threads, the pipe
+        # is only written to while it is known to be open
+        self.wake_lock = threading.Lock()
+
+    def split_lines(self, received):
+        # cut every complete line off the front of the receive buffer,
+        # leaving any partial line in place for the next read
+        end = max(received.rfind(b'\n'), received.rfind(b'\r'))
+        if end < 0:
+            return []
+
+        chunk = bytes(received[:end]).replace(b'\r', b'\n')
+        del received[:end + 1]
+
+        return [line for line in chunk.split(b'\n') if len(line) > 0]
+
+    def read_waiting(self, received):
+        # read everything the port has buffered in one go and emit the
+        # complete lines, returns the number of bytes that were waiting or
+        # None when the read failed and should be tried again
+        port = self.controller.port
+        waiting = 0
+        try:
+            if port is not None and port.isOpen():
+                waiting = port.inWaiting()
+
+            if waiting > 0:
+                received.extend(port.read(waiting))
+        except (serial.SerialException, OSError) as e:
+            self.logger.debug('Read failed: ' + str(e))
+            return None
+
+        if waiting > 0:
+            lines = self.split_lines(received)
+            if len(lines) > 0:
+                self.logger.debug(
+                    str(round(time.time() * 1000)) +
+                    ' Received ' + str(len(lines)) + ' lines')
+                self.lines_received.emit(lines)
+
+        return waiting
+
     def receive(self):
-        line = ''
+        received = bytearray()
         delay = self.controller.statusInterval() / 10
         timeout = 0
         while timeout < (2000 * delay) and self.exit_loop is False:
             try:
-                if self.controller.port is not None and \
-                        self.controller.port.isOpen() and \
-                        self.controller.port.inWaiting() > 0:
-                    try:
-                        character = self.controller.port.read(1)
-                        # self.logger.debug(
-                        #    str(round(time.time() * 1000)) +' Received: ' +
-                        #    character + '('+ str(ord(character)) +')')
-                    except:
-                        time.sleep(delay)
-                        continue
-
-                    if character != chr(13) and character != chr(10):
-                        line += character
-                        timeout = 0
-                    else:
-
-                        self.logger.debug(
-                            str(round(time.time() * 1000)) +
-                            ' Received Line: ' +
-                            line)
-                        if len(line) > 0:
-                            self.logger.debug(' Line has length')
-                            self.line_received.emit(line)
-                            line = ''
-
+                waiting = self.read_waiting(received)
+                if waiting is not None and waiting > 0:
+                    timeout = 0
                 else:
                     # self.logger.debug(
                     #    str(round(time.time() * 1000)) +
@@ -66,60 +95,319 @@ class ControllerBoardListener(QtCore.QThread):
         self.logger.debug('Listener Exiting')
         self.exit = False
 
+    def open_wake_pipe(self):
+        # blocking on the port needs a real file descriptor and a pipe
+        # exit() can write to so a waiting select returns immediately
+        port = self.controller.port
+        if os.name == 'nt' or port is None or not hasattr(port, 'fileno'):
+            return False
+
+        try:
+            self.port_fileno = port.fileno()
+            self.wake_pipe = os.pipe()
+        except (OSError, ValueError, serial.SerialException):
+            return False
+
+        return True
+
+    def close_wake_pipe(self):
+        with self.wake_lock:
+            wake_pipe = self.wake_pipe
+            self.wake_pipe = None
+            if wake_pipe is not None:
+                for fileno in wake_pipe:
+                    try:
+                        os.close(fileno)
+                    except OSError:
+                        pass
+
+    def receive_events(self):
+        received = bytearray()
+        delay = self.controller.statusInterval() / 10
+        idle_timeout = 2000 * delay
+        last_received = time.time()
+        while self.exit_loop is False:
+            remaining = idle_timeout - (time.time() - last_received)
+            if remaining <= 0:
+                break
+
+            try:
+                readable = select.select(
+                    [self.port_fileno, self.wake_pipe[0]], [], [],
+                    remaining)[0]
+            except (select.error, ValueError, TypeError):
+                self.logger.debug('select failed')
+                break
+
+            if self.wake_pipe[0] in readable:
+                os.read(self.wake_pipe[0], 64)
+
+            if self.port_fileno in readable:
+                waiting = self.read_waiting(received)
+                if waiting is None:
+                    # try again shortly, the port stays readable until the
+                    # read goes through or it times out
+                    time.sleep(delay)
+                    continue
+                if waiting == 0:
+                    # readable with nothing waiting, the port has gone
+                    self.logger.debug('Port closed')
+                    break
+
+                last_received = time.time()
+
+        self.close_wake_pipe()
+        self.logger.debug('Listener Exiting')
+
     def run(self):
-        self.receive()
+        if conf.get('connection.event_driven_listener') and \
+                self.open_wake_pipe():
+            self.receive_events()
+        else:
+            self.receive()
 
     def exit(self):
         self.logger.debug('Setting Exit flag')
         self.exit_loop = True
 
+        # wake the listener if it is blocked waiting on the port
+        with self.wake_lock:
+            if self.wake_pipe is not None:
+                try:
+                    os.write(self.wake_pipe[1], b'x')
+                except OSError:
+                    pass
+
+
+from collections import deque, Iterator
+
+
+class ReceiveBuffer(object):
+
+    """
+      Character counting for the board's serial receive buffer, every
+      line written is held against the buffer until the board
+      acknowledges it, so the sender knows how much room is left
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pending = deque([])
+        self.used = 0
+        self.condition = threading.Condition()
+
+        # nothing has been written since the last acknowledgement
+        self.settled = True
+
+    def reserve(self, length, timeout=None):
+        # an empty buffer always takes the line, even an oversized one
+        with self.condition:
+            if self.used > 0 and (self.used + length) > self.size:
+                self.condition.wait(timeout)
+                return False
+
+            self.pending.append(length)
+            self.used += length
+            self.settled = False
+            return True
+
+    def add(self, length):
+        with self.condition:
+            self.pending.append(length)
+            self.used += length
+            self.settled = False
+
+    def cancel(self, lengths):
+        # give back lines reserved but never written, they are the last ones
+        # reserved so they are looked for from the newest end, any a clear
+        # already dropped are skipped
+        with self.condition:
+            for length in reversed(lengths):
+                for index in range(len(self.pending) - 1, -1, -1):
+                    if self.pending[index] == length:
+                        del self.pending[index]
+                        self.used -= length
+                        break
+            self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            if len(self.pending) > 0:
+                self.used -= self.pending.popleft()
+            self.settled = True
+            self.condition.notify_all()
 
-from collections import deque
+    def clear(self):
+        with self.condition:
+            self.pending = deque([])
+            self.used = 0
+            self.settled = True
+            self.condition.notify_all()
+
+    def clear_settled(self):
+        # drop what is left over from missed acknowledgements, only once
+        # every line written has had the chance to be acknowledged, lines
+        # written after the last acknowledgement may still be on the way
+        with self.condition:
+            if self.settled:
+                self.pending = deque([])
+                self.used = 0
+                self.condition.notify_all()
 
 
 class ControllerBoardSender(QtCore.QThread):
 
-    ready = QtCore.pyqtSignal()
-    block = QtCore.pyqtSignal()
-    line_sent = QtCore.pyqtSignal(str)
+    lines_sent = QtCore.pyqtSignal(list)
     controller = None
+    planner_budget = None
 
     def __init__(self, parent=None, queue_name=False):
         QtCore.QThread.__init__(self, parent)
         self.logger = logging.getLogger(__name__ + ':' + queue_name)
-        self.ready.connect(self.ready_received_handler)
-        self.block.connect(self.block_received_handler)
         self.commands = deque([])
 
         self.log_command = False
 
         self.paused = False
         self.clear_to_send = True
+        self.streaming = False
+        self.resets = 0
+
+        # the queue report parser and pause/resume flip the gate under this
+        # condition so a blocked sender wakes as soon as it opens
+        self.condition = threading.Condition()
+        self.blocked_time = 0.0
 
     def send_line(self, controller, line):
+        if not self.streaming and self.controller.port is not None:
+            # keep the count of bytes in the board's buffer in step
+            controller.rx_buffer.add(len(line) + 1)
+
+        self.send_lines(controller, [line])
+
+    def send_lines(self, controller, lines):
         if self.controller.port is not None and self.controller.port.isOpen():
             if self.log_command:
-                self.logger.debug('Sender sending ' + line)
-            bytes = self.controller.port.write(line + '\n')
+                self.logger.debug(
+                    'Sender sending ' + str(len(lines)) + ' lines')
+            bytes = self.controller.port.write('\n'.join(lines) + '\n')
             if self.log_command:
                 self.logger.debug('wrote ' + str(bytes) + ' bytes')
         if self.log_command:
-            self.line_sent.emit(line)
+            self.lines_sent.emit(lines)
         # controller.requestCommandQueueSize()
 
+    def next_command(self):
+        # lazy sources such as an open file sit in the queue until they run
+        # dry, their lines are pulled out in front of them one at a time
+        commands = self.commands
+        while len(commands) > 0 and isinstance(commands[0], Iterator):
+            try:
+                commands.appendleft(next(commands[0]))
+            except StopIteration:
+                commands.popleft()
+
+        if len(commands) > 0:
+            return commands[0]
+
+        return None
+
+    def next_batch(self, controller, timeout):
+        # take as many queued lines as fit in the board's receive buffer
+        # and the free planner slots, only the first line waits for room
+        commands = self.commands
+        budget = self.planner_budget
+        batch = []
+        while len(commands) > 0 and (budget is None or len(batch) < budget):
+            command = self.next_command()
+            if command is None or not controller.rx_buffer.reserve(
+                    len(command) + 1, timeout if len(batch) == 0 else 0):
+                break
+
+            commands.popleft()
+            batch.append(command)
+
+        return batch
+
+    def wait_until_clear(self):
+        # sleep for as long as the sender is paused or the board's planner
+        # is full, returns straight away when neither is the case
+        with self.condition:
+            if not self.paused and self.clear_to_send:
+                return
+
+            self.logger.debug('Sender is blocked/paused')
+            blocked_at = time.time()
+            while (self.paused or not self.clear_to_send) and \
+                    len(self.commands) > 0:
+                self.condition.wait()
+            self.blocked_time += time.time() - blocked_at
+
+    def set_planner_budget(self, budget):
+        with self.condition:
+            self.planner_budget = budget
+            self.condition.notify_all()
+
+    def spend_planner_budget(self, lines):
+        # the free slots of a queue report are shared by every line sent
+        # until the next one
+        with self.condition:
+            if self.planner_budget is not None:
+                self.planner_budget = max(0, self.planner_budget - lines)
+
+    def wait_for_planner_budget(self, timeout):
+        # once the lines sent have used up the free slots nothing more goes
+        # until the next queue report, the board reports whenever its queue
+        # changes so with no report in time the lines took no slots
+        with self.condition:
+            if self.planner_budget != 0:
+                return
+
+            self.condition.wait(timeout)
+            if self.planner_budget == 0:
+                self.planner_budget = 1
+
+    def stream(self, controller):
+        # character counting protocol, lines are written back to back for
+        # as long as the board's receive buffer has room for them
+        delay = controller.statusInterval()
+        while len(self.commands) > 0:
+            self.wait_for_planner_budget(delay)
+            self.wait_until_clear()
+
+            resets = self.resets
+            batch = self.next_batch(controller, delay)
+
+            # drop the batch if the queue was reset while it was built,
+            # along with the room it took in the receive buffer
+            if len(batch) > 0 and resets == self.resets:
+                self.send_lines(controller, batch)
+                self.spend_planner_budget(len(batch))
+            elif len(batch) > 0:
+                controller.rx_buffer.cancel(
+                    [len(command) + 1 for command in batch])
+
     def send(self, controller):
+        if self.streaming:
+            self.stream(controller)
+            return
+
         delay = controller.statusInterval()
         while len(self.commands) > 0:
-            if self.paused or not self.clear_to_send:
-                self.logger.debug('Sender is blocked/paused')
-            else:
+            self.wait_until_clear()
+
+            # the queue is swapped for an empty one when it is reset, a
+            # command taken from the old one is dropped and the old one is
+            # the one popped from
+            resets = self.resets
+            commands = self.commands
+            command = self.next_command()
+            if command is not None and resets == self.resets:
                 if self.log_command:
                     self.logger.debug(
-                        'command queue size: ' + str(len(self.commands)))
-                    if len(self.commands) > 0:
-                        self.logger.debug(
-                            ' the first element is ' + self.commands[0])
-                command = self.commands.popleft()
+                        'command queue size: ' + str(len(commands)))
+                    self.logger.debug(' the first element is ' + command)
+                commands.popleft()
 
                 if self.log_command:
                     self.logger.debug('Sender thread sending ' + str(command))
@@ -133,100 +421,121 @@ class ControllerBoardSender(QtCore.QThread):
         if self.log_command:
             self.logger.debug('appending ' + str(len(commands)) + ' commands')
         for command in commands:
-            if len(command) > 0:
+            if isinstance(command, Iterator) or len(command) > 0:
                 self.commands.append(command)
                 if self.log_command:
                     self.logger.debug(
                         'first command is ' +
-                        self.commands[len(self.commands) - 1])
+                        str(self.commands[len(self.commands) - 1]))
 
     def prepend_commands(self, commands):
         if self.log_command:
             self.logger.debug('prepending ' + str(commands))
         commands.reverse()
         for command in commands:
-            if len(command) > 0:
+            if isinstance(command, Iterator) or len(command) > 0:
                 self.commands.append(command)
                 if self.log_command:
-                    self.logger.debug('first command is ' + self.commands[0])
-
-    def ready_received_handler(self):
-        if self.log_command:
-            self.logger.debug('ready to send')
-        self.clear_to_send = True
+                    self.logger.debug(
+                        'first command is ' + str(self.commands[0]))
 
-    def block_received_handler(self):
-        if self.log_command:
-            self.logger.debug('blocking send')
-        self.clear_to_send = False
+    def set_clear_to_send(self, clear_to_send):
+        if self.log_command and clear_to_send != self.clear_to_send:
+            self.logger.debug(
+                'ready to send' if clear_to_send else 'blocking send')
+        with self.condition:
+            self.clear_to_send = clear_to_send
+            self.condition.notify_all()
 
     def pause(self):
         if self.log_command:
             self.logger.debug('pauseing sender')
-        self.paused = True
+        with self.condition:
+            self.paused = True
 
     def resume(self):
         if self.log_command:
             self.logger.debug('resumeing sender')
-        self.paused = False
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
 
     def reset(self):
         if self.log_command:
             self.logger.debug('resetting sender')
         self.pause()
         self.commands = deque([])
+        self.resets += 1
         self.resume()
 
     def run(self):
         if self.controller is not None:
-            self.clear_to_send = True
+            self.set_clear_to_send(True)
             if self.log_command:
                 self.logger.debug('Sender thread started')
             self.send(self.controller)
+            if self.log_command:
+                self.logger.debug(
+                    'Sender thread finished, blocked for ' +
+                    str(round(self.blocked_time, 3)) + 's')
         else:
             if self.log_command:
                 self.logger.debug('Sender thread started without a controller')
 
 
-class FileTimer(QtCore.QThread):
-    last_start_time = None
-    total = 0
-    paused = False
+class FileTimer(QtCore.QObject):
+
+    """
+      elapsed running time of a file, ticked by the shared scheduler while
+      the file runs and left out of the schedule while paused or stopped
+    """
+
     timer_tick = QtCore.pyqtSignal(float)
+    tick_interval = 0.5
 
-    def __init__(self, parent=None):
-        QtCore.QThread.__init__(self, parent)
+    def __init__(self, scheduler, parent=None):
+        super(FileTimer, self).__init__(parent)
         self.logger = logging.getLogger(__name__)
+        self.last_start_time = None
+        self.total = 0
+        self.job = scheduler.add(
+            self.tick_interval, self.report_time, paused=True)
+
+    def elapsed(self):
+        total = self.total
+        if self.last_start_time is not None:
+            total += monotonic() - self.last_start_time
 
-    def go(self):
-        self.last_start_time = time.time()
-        # threading.Timer(0.5, self.report_time).start()
-        self.report_time()
+        return total
 
     def report_time(self):
-        # self.logger.debug('currently paused:' + str(self.paused))
-        if self.paused is False and self.last_start_time is not None:
-            self.timer_tick.emit(
-                self.total + (time.time() - self.last_start_time))
-        threading.Timer(0.5, self.report_time).start()
+        self.timer_tick.emit(self.elapsed())
+
+    def start(self):
+        self.total = 0
+        self.resume()
 
     def reset(self):
+        self.job.pause()
         self.last_start_time = None
         self.total = 0
 
     def pause(self):
         self.logger.debug('pause timer')
-        self.paused = True
+        self.job.pause()
 
         if self.last_start_time is not None:
-            self.total += (time.time() - self.last_start_time)
+            self.total += (monotonic() - self.last_start_time)
+            self.last_start_time = None
+            self.report_time()
 
     def resume(self):
-        self.last_start_time = time.time()
-        self.paused = False
+        if self.last_start_time is None:
+            self.last_start_time = monotonic()
+        self.job.resume()
 
-    def run(self):
-        self.go()
+    def stop(self):
+        self.job.stop()
 
 
 class ControllerBoard(QtCore.QObject):
@@ -240,18 +549,31 @@ class ControllerBoard(QtCore.QObject):
     listener_thread = None
     sender_thread = None
     control_sender_thread = None
-    timer_thread = None
+    preflight_thread = None
+    file_timer = None
+    scheduler = None
     paused = False
     logging = True
     movement_gcode = 'G0'
     port = None
     absolute = None
 
+    rx_buffer_size = 0
+    simulator_port_name = None
+
     number_of_commands = 0
     commands_executed = 0
     queue_size = 0
     tracking_progress = False
     session_id = None
+    counting_file_path = None
+    file_analysis = None
+
+    # seconds between writes of the position journal while moving
+    position_journal_interval = 5.0
+
+    # decimal places kept for each word when file precision is restricted
+    word_decimals = gcode.word_decimals
 
     def statusInterval(self):
         return 0.5
@@ -263,21 +585,48 @@ class ControllerBoard(QtCore.QObject):
         self.main_window = main_window
         self.connected = False
         self.session_id = self.id_generator(20)
+        self.session_pattern = patterns.session(self.session_id)
+        self.rx_buffer = ReceiveBuffer(self.rx_buffer_size)
+        self.machine_state = MachineState()
+        self.position_journal = self.load_position_journal()
+        self.program_cache = ProgramCache(
+            conf.get('common.program_cache_directory'))
+        self.number_rewriter = gcode.NumberRewriter(self.word_decimals)
+
+        # periodic work all runs on the one scheduler thread
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.file_timer = FileTimer(self.scheduler)
+        self.file_timer.timer_tick.connect(self.timer_tick_handler)
+        conf.schedule_writes(self.scheduler)
+
+        # positions are written out every few seconds, when the machine goes
+        # idle and when the application quits
+        self.scheduler.add(
+            self.position_journal_interval, self.position_journal.flush)
+        application = QtCore.QCoreApplication.instance()
+        if application is not None:
+            application.aboutToQuit.connect(self.position_journal.flush)
+            application.aboutToQuit.connect(self.stop_scheduler)
 
         # setup event handlers
         pub.subscribe(self.reset_received_handler, 'reset-received')
         pub.subscribe(self.queue_size_handler, 'queue-size')
         pub.subscribe(self.start_of_file_handler, 'start-of-file-received')
         pub.subscribe(self.end_of_file_handler, 'end-of-file-received')
+        pub.subscribe(self.idle_received_handler, 'idle')
 
     def queue_size_handler(self, size):
         if self.sender_thread is not None and self.sender_thread.isRunning():
             # block only the default sender thread
             # the control sender must not be blocked
-            if size < (self.command_queue_slots - 4):
-                self.sender_thread.ready.emit()
-            else:
-                self.sender_thread.block.emit()
+            self.sender_thread.set_clear_to_send(
+                size < (self.command_queue_slots - 4))
+
+            # cap how many lines go out before the next report to the
+            # free slots
+            self.sender_thread.set_planner_budget(
+                max(1, self.command_queue_slots - 4 - size))
 
     def id_generator(
             self,
@@ -291,18 +640,17 @@ class ControllerBoard(QtCore.QObject):
         self.listener_thread = ControllerBoardListener()
         self.listener_thread.daemon = True
         self.listener_thread.controller = self
-        self.listener_thread.line_received.connect(self.line_received_handler)
+        self.listener_thread.lines_received.connect(
+            self.lines_received_handler)
         self.listener_thread.start()
 
     def timer(self):
-        if self.timer_thread is None:
-            self.logger.debug('Start file timer')
-            self.timer_thread = FileTimer()
-            self.timer_thread.daemon = True
-            self.timer_thread.timer_tick.connect(self.timer_tick_handler)
-            self.timer_thread.start()
-        else:
-            self.timer_thread.reset()
+        self.logger.debug('Start file timer')
+        self.file_timer.start()
+
+    def stop_scheduler(self):
+        self.scheduler.stop()
+        self.scheduler.wait()
 
     def timer_tick_handler(self, total):
         pub.sendMessage('timer-tick', total=total)
@@ -318,6 +666,11 @@ class ControllerBoard(QtCore.QObject):
     def sender(self, commands, prepend=False, control=False):
         self.logger.debug('Sender ' + str(type(commands)))
 
+        if isinstance(commands, Iterator):
+            # lazy sources are filtered as they are read and counted apart
+            self.default_sender([commands], prepend)
+            return
+
         if type(commands) is str:
             self.logger.debug('splitting ' + str(type(commands)))
             commands = commands.split('\n')
@@ -340,17 +693,9 @@ class ControllerBoard(QtCore.QObject):
                     'filtered ' + command + ' ' + str(len(command)))
 
                 if command is not None and len(command) > 0:
-                    match = re.search(r'^(?:M|G|T|S|F)(\d+)', command)
-                    if match is not None:
-                        # groups = match.groups()
-                        # if ['0','1','2','3'].count(groups[0]) >0:
-                        self.number_of_commands += 1
-
-                        # add three more queue planner slots for archs
-                        match = re.search(r'^G0?[23]', command)
-                        if match is not None:
-                            self.number_of_commands += 3
-
+                    slots = self.command_slots(command)
+                    if slots > 0:
+                        self.number_of_commands += slots
                         self.logger.debug(
                             'command counter now at ' +
                             str(self.number_of_commands))
@@ -365,6 +710,146 @@ class ControllerBoard(QtCore.QObject):
         else:
             self.default_sender(filtered_commands, prepend)
 
+    def command_slots(self, command, tokens=None):
+        # number of planner queue slots a command is expected to take up
+        return gcode.command_slots(command, tokens)
+
+    def file_commands(self, file_path, rewriter=None):
+        # read, filter and yield the commands in a file line by line, the
+        # commands of a file processed before are read back from the cache,
+        # a file not hashed yet is processed rather than hashed here so the
+        # first line goes out straight away
+        key = self.known_preflight_key(file_path)
+        lines_path = None
+        if key is not None:
+            lines_path = self.program_cache.lines_path(key)
+        if lines_path is not None:
+            for command in gcode.read_lines(lines_path):
+                yield command
+            return
+
+        for command in self.process_lines(
+                gcode.read_lines(file_path), rewriter):
+            yield command
+
+    def process_lines(self, lines, rewriter=None):
+        # the commands sent for some lines of a file, rewriter counts the
+        # bytes restricting precision saves for the file
+        if not bool(conf.get('common.restrict_file_precision')):
+            rewriter = None
+        elif rewriter is None:
+            rewriter = self.number_rewriter
+
+        return gcode.process_lines(
+            lines, bool(conf.get('common.filter_file_commands')), rewriter)
+
+    def arc_slot_counter(self):
+        # counts the planner queue slots an arc is expected to take up
+        return preflight.ArcSlots()
+
+    def planner_settings(self):
+        # board settings that change arc_slot_counter or planner_limits,
+        # part of the preflight key
+        return None
+
+    def planner_limits(self):
+        # velocity, jerk and junction limits for the time estimate, None
+        # when they are not known
+        return None
+
+    def count_file_commands(self, file_path):
+        # a preflight pass counts the file, progress is reported against
+        # its count once it is done
+        self.counting_file_path = file_path
+        self.preflight(file_path)
+
+    def commands_counted_handler(self, total):
+        self.number_of_commands += total
+
+    def preflight_settings(self):
+        return (
+            conf.get('common.board_type'),
+            bool(conf.get('common.filter_file_commands')),
+            bool(conf.get('common.restrict_file_precision')),
+            tuple(sorted(self.word_decimals.items())),
+            self.planner_settings())
+
+    def preflight_key(self, file_path):
+        return self.program_cache.key(file_path, *self.preflight_settings())
+
+    def known_preflight_key(self, file_path):
+        # the key of a file hashed before, found without reading the file,
+        # None when it has to be hashed
+        return self.program_cache.known_key(
+            file_path, *self.preflight_settings())
+
+    def cached_analysis(self, key):
+        # analyses from earlier sessions are loaded from the program cache
+        if key is None:
+            return None
+
+        if key not in preflight.cache:
+            analysis = self.program_cache.load(key)
+            if analysis is None:
+                return None
+            preflight.cache[key] = analysis
+
+        return preflight.cache[key]
+
+    def preflight(self, file_path):
+        # analyse a file once it is chosen, a file analysed before with the
+        # same settings comes straight from the cache, hashing a large file
+        # takes a while so a file not hashed before is hashed and looked up
+        # on the preflight thread
+        settings = self.preflight_settings()
+        key = self.known_preflight_key(file_path)
+
+        # a file still being analysed, such as one started straight after
+        # it was chosen, is left to finish rather than analysed again, its
+        # analysis goes to the count when it arrives
+        thread = self.preflight_thread
+        if thread is not None and thread.isRunning() and \
+                not thread.exit_loop and thread.file_path == file_path and \
+                thread.settings == settings and \
+                (thread.key is None or thread.key == key):
+            return
+
+        if thread is not None:
+            thread.exit()
+
+        analysis = self.cached_analysis(key)
+        if analysis is not None:
+            self.preflight_handler(file_path, analysis)
+            return
+
+        # large files are split over one process per core unless the
+        # number of processes is set
+        processes = preprocess.process_count(file_path)
+        if processes > 1:
+            self.preflight_thread = preprocess.ParallelPreflight(
+                file_path, key, None)
+            self.preflight_thread.processes = processes
+        else:
+            rewriter = gcode.NumberRewriter(self.word_decimals)
+            self.preflight_thread = preflight.Preflight(
+                file_path, key, self.file_commands(file_path, rewriter))
+            self.preflight_thread.rewriter = rewriter
+        self.preflight_thread.daemon = True
+        self.preflight_thread.controller = self
+        self.preflight_thread.settings = settings
+        self.preflight_thread.limits = self.planner_limits()
+        self.preflight_thread.analysed.connect(self.preflight_handler)
+        self.preflight_thread.start()
+
+    def preflight_handler(self, file_path, analysis):
+        if file_path == self.counting_file_path:
+            self.counting_file_path = None
+            self.file_analysis = analysis
+            self.commands_counted_handler(analysis.command_slots)
+
+        pub.sendMessage(
+            'preflight-complete', file_path=file_path, analysis=analysis)
+
     def default_sender(self, commands, prepend=False):
         # start a new sender or add the new commands to the command queue
         if self.sender_thread is None or not self.sender_thread.isRunning():
@@ -375,8 +860,11 @@ class ControllerBoard(QtCore.QObject):
             self.sender_thread.daemon = True
             self.sender_thread.controller = self
             self.sender_thread.log_command = True
+            self.sender_thread.streaming = (
+                self.rx_buffer_size > 0 and
+                bool(conf.get('connection.character_counting')))
 
-            self.sender_thread.line_sent.connect(self.line_sent_handler)
+            self.sender_thread.lines_sent.connect(self.lines_sent_handler)
 
             if prepend:
                 self.logger.debug('Prepend to sender queue')
@@ -405,8 +893,8 @@ class ControllerBoard(QtCore.QObject):
             self.control_sender_thread.controller = self
             self.control_sender_thread.log_command = True
 
-            self.control_sender_thread.line_sent.connect(
-                self.line_sent_handler)
+            self.control_sender_thread.lines_sent.connect(
+                self.lines_sent_handler)
 
             self.logger.debug('Append to control sender queue')
             self.control_sender_thread.append_commands(commands)
@@ -416,6 +904,32 @@ class ControllerBoard(QtCore.QObject):
             self.logger.debug('Append to existing control sender queue')
             self.control_sender_thread.append_commands(commands)
 
+    def reset_received_handler(self):
+        # the board empties its receive buffer when it resets, none of the
+        # lines still counted against it will be acknowledged
+        self.rx_buffer.clear()
+
+    def idle_received_handler(self):
+        # the board can report idle with lines still in flight, the count
+        # is only dropped when nothing was written since the last
+        # acknowledgement
+        self.rx_buffer.clear_settled()
+        self.position_journal.flush()
+
+    def load_position_journal(self):
+        journal = PositionJournal()
+        if not journal.load():
+            # carry over positions saved in the config file by older versions
+            last_positions = conf.get('last_positions')
+            if last_positions is not None:
+                for axis_letter, position in last_positions.items():
+                    journal.record(axis_letter, float(position))
+
+        return journal
+
+    def is_acknowledgement(self, line):
+        return False
+
     def idling_handler(self):
         self.logger.debug('Not listening')
         pub.sendMessage('idling')
@@ -492,9 +1006,24 @@ class ControllerBoard(QtCore.QObject):
 
         self.send(command)
 
+    def publish_state_changes(self):
+        # one notification for everything a batch of lines changed
+        changes = self.machine_state.take_changes()
+        if len(changes) > 0:
+            pub.sendMessage('machine-state-changed', changes=changes)
+
+    def lines_received_handler(self, lines):
+        for line in lines:
+            self.line_received_handler(line)
+        self.publish_state_changes()
+
     def line_received_handler(self, line):
         self.logger.debug('line_received_handler: ' + line)
-        line = self.filter_response(str(line).strip())
+        line = str(line).strip()
+        if self.is_acknowledgement(line):
+            self.rx_buffer.release()
+
+        line = self.filter_response(line)
         log = self.parse_response(line)
 
         pub.sendMessage('line-received', line=line, log=log)
@@ -519,17 +1048,18 @@ class ControllerBoard(QtCore.QObject):
 
     def pause_timer(self):
         self.logger.debug('pause_timer')
-        if self.timer_thread is not None:
-            self.logger.debug('pauseing timer_thread')
-            self.timer_thread.pause()
+        self.file_timer.pause()
 
     def reset_timer(self):
-        if self.timer_thread is not None:
-            self.timer_thread.reset()
+        self.file_timer.reset()
 
     def resume_timer(self):
-        if self.timer_thread is not None:
-            self.timer_thread.resume()
+        self.file_timer.resume()
+
+    def lines_sent_handler(self, lines):
+        for line in lines:
+            self.line_sent_handler(line)
+        self.publish_state_changes()
 
     def line_sent_handler(self, line):
         self.logger.debug('line_sent_handler: ' + line)
@@ -548,109 +1078,85 @@ class ControllerBoard(QtCore.QObject):
 
     def filter_file(self, contents):
         # strip blank lines and comments
-        contents = re.sub(r' +([MTG])', r'\n\1', contents)
-        contents = re.sub(
-            r'^(\(|;)[^\)]*\)\s*$',
-            '', contents, flags=re.MULTILINE)
-        contents = re.sub(r'\n\s*\n', '\n', contents, flags=re.MULTILINE)
+        contents = patterns.file_word_split.sub(r'\n\1', contents)
+        contents = patterns.file_comment_line.sub('', contents)
+        contents = patterns.file_blank_lines.sub('\n', contents)
 
         return contents
 
-    def filter_request(self, line):
-        self.logger.debug('Filtering request ' + line)
-
-        if conf.get('common.restrict_file_precision') == 1:
-            line = line.replace(
-                r'([XYZIJKRP])\s*([\-\+\d])(\.(\d{0,4})\d*)?', r'\1\2\4')
+    def filter_request(self, line, rewriter=None):
+        if bool(conf.get('common.restrict_file_precision')):
+            line = (rewriter or self.number_rewriter).rewrite(line)
 
         return line
 
-    def parse_distance_mode(self, line):
+    def parse_distance_mode(self, line, tokens=None):
         # monitor requests to switch the absolute mode flag
-        match = re.search(r'^(G9[01])', line)
-        if match is not None:
-            self.logger.debug('Switching distance mode')
-            groups = match.groups()
+        if tokens is None:
+            tokens = gcode.tokenize(line)
+
+        for code in gcode.codes(tokens, 'G'):
+            if code == 90 or code == 91:
+                self.logger.debug('Switching distance mode')
 
-            self.absolute = (groups[0] == 'G90')
-            pub.sendMessage(
-                'dist-mode-received', dist_mode=int(groups[0] != 'G90'))
+                self.absolute = (code == 90)
+                self.machine_state.update(absolute=self.absolute)
 
         return True
 
-    def parse_feed_rate(self, line):
+    def parse_feed_rate(self, line, tokens=None):
         # monitor requests to change the feed rate
-        match = re.search(r'F([\d\.]+)', line)
-        if match is not None:
-            self.logger.debug('Switching feed rate')
-            groups = match.groups()
+        if tokens is None:
+            tokens = gcode.tokenize(line)
 
-            feedrate = re.sub(r'[^\d\.]', '', groups[0])
-            pub.sendMessage('feed-rate-sent', rate=feedrate)
+        for feed_rate in gcode.codes(tokens, 'F'):
+            self.logger.debug('Switching feed rate')
+            self.machine_state.update(feed_rate=abs(feed_rate))
 
             return False
 
         return True
 
-    def parse_request(self, line):
+    def parse_request(self, line, tokens=None):
         self.logger.debug('Parsing request: ' + line)
 
-        log = self.parse_feed_rate(line)
-
-        # turn the coolant on
-        match = re.search(r'^M[78]', line)
-        if match is not None and \
-                not self.main_window.ui.checkBoxCoolant.isChecked():
-            self.main_window.ui.checkBoxCoolant.setChecked(True)
-
-        # turn the coolant off
-        match = re.search(r'^M9', line)
-        if match is not None and \
-                self.main_window.ui.checkBoxCoolant.isChecked():
-            self.main_window.ui.checkBoxCoolant.setChecked(False)
-
-        # turn the spindle on and set the direction
-        match = re.search(r'^M([34])', line)
-        if match is not None and \
-                not self.main_window.ui.checkBoxSpindle.isChecked():
-            groups = match.groups()
-            self.main_window.ui.checkBoxSpindle.setChecked(True)
-            if groups[0] == '3' and not \
-                    self.main_window.ui.radioSpindleDirectionCW.isChecked():
-                self.main_window.ui.radioSpindleDirectionCW.setChecked(True)
-            elif groups[0] == '4' and not \
-                    self.main_window.ui.radioSpindleDirectionCCW.isChecked():
-                self.main_window.ui.radioSpindleDirectionCCW.setChecked(True)
-
-        # set or add the spindle speed
-        match = re.search(r'^(?:M[34] )?S(\d+)', line)
-        if match is not None:
-            groups = match.groups()
-            speed_index = self.main_window.ui.comboSpindleSpeed.findText(
-                groups[0])
-            if speed_index < 0:
-                self.main_window.ui.comboSpindleSpeed.addItem(groups[0])
-            speed_index = self.main_window.ui.comboSpindleSpeed.findText(
-                groups[0])
-            self.main_window.ui.comboSpindleSpeed.setCurrentIndex(speed_index)
-
-        # turn the spindle off
-        match = re.search(r'^M5', line)
-        if match is not None and \
-                self.main_window.ui.checkBoxSpindle.isChecked():
-            self.main_window.ui.checkBoxSpindle.setChecked(False)
-
-        # scan for Gcodes and figure out reverse command
-        match = re.search(r'^G(\d+)(.*)', line)
-        if match is not None:
-            groups = match.groups()
-            # if groups[0] == '':
-
-        log = self.parse_distance_mode(line) and log
-
-        session_re = re.compile('_' + self.session_id + '_')
-        match = re.search(session_re, line)
-        if match is not None:
+        # the line is tokenized once and every check below reads the words
+        if tokens is None:
+            tokens = gcode.tokenize(line)
+        m_codes = gcode.codes(tokens, 'M')
+
+        log = self.parse_feed_rate(line, tokens)
+        state = self.machine_state
+
+        # coolant on and off
+        if 7 in m_codes or 8 in m_codes:
+            state.update(coolant=True)
+        if 9 in m_codes:
+            state.update(coolant=False)
+
+        # spindle on with its direction
+        if 3 in m_codes:
+            state.update(spindle=True, spindle_direction=0)
+        elif 4 in m_codes:
+            state.update(spindle=True, spindle_direction=1)
+
+        for speed in gcode.codes(tokens, 'S'):
+            state.update(spindle_speed=int(speed))
+
+        # spindle off
+        if 5 in m_codes:
+            state.update(spindle=False)
+
+        # units
+        g_codes = gcode.codes(tokens, 'G')
+        if 20 in g_codes:
+            state.update(units=0)
+        elif 21 in g_codes:
+            state.update(units=1)
+
+        log = self.parse_distance_mode(line, tokens) and log
+
+        if self.session_pattern.search(line) is not None:
             log = False
 
         return log
@@ -663,10 +1169,11 @@ class ControllerBoard(QtCore.QObject):
         self.send(command)
 
     def progress(self, increment_commands=0):
+        # keep counting while the file is still being counted
+        self.commands_executed += increment_commands
         if self.number_of_commands == 0:
             return 0
 
-        self.commands_executed += increment_commands
         self.logger.debug(
             'progress: ' + str(self.commands_executed) +
             '/' + str(self.number_of_commands))
@@ -674,6 +1181,14 @@ class ControllerBoard(QtCore.QObject):
             float(self.commands_executed) /
             float(self.number_of_commands), 2) * 100)
 
+    def remaining_time(self):
+        # seconds the rest of the running file is expected to take, from
+        # the planner slots the board has finished so far
+        if self.file_analysis is None:
+            return None
+
+        return self.file_analysis.remaining_time(self.commands_executed)
+
     def clear(self):
         self.logger.debug('controller stopping and clearing')
         self.reset_sender()
@@ -690,20 +1205,22 @@ class ControllerBoard(QtCore.QObject):
         pub.sendMessage('programme-progress', progress=0)
         pub.sendMessage('queue-size', size=0)
 
-        content = ''
-        with open(file_path) as f:
-            content = f.read()
-
-        if bool(conf.get('common.filter_file_commands')):
-            content = self.filter_file(content)
-            # self.logger.debug('filtered file:' + content)
-
-        if content is not None and content != '':
+        # the file is read as it is sent rather than loaded up front
+        if os.path.getsize(file_path) > 0:
             self.commands_executed = 0
             self.queue_size = 0
             self.number_of_commands = 0
             self.clear_command_queue()
 
+            # the preflight analysis already knows how many commands to expect
+            analysis = self.cached_analysis(
+                self.known_preflight_key(file_path))
+            self.file_analysis = analysis
+            if analysis is not None:
+                self.number_of_commands = analysis.command_slots
+            else:
+                self.count_file_commands(file_path)
+
             # wait for the sender to become ready
             while self.sender_thread is not None and \
                     self.sender_thread.isRunning():
@@ -711,8 +1228,15 @@ class ControllerBoard(QtCore.QObject):
 
             self.tracking_progress = True
             self.timer()
+            # repeated modal words are dropped as the file is sent, after
+            # the preflight has seen every line, and every file starts from
+            # a state the minimizer does not yet know
+            commands = self.file_commands(file_path)
+            if bool(conf.get('common.minimize_file_commands')):
+                commands = gcode.minimize_lines(commands)
+
             self.echo_back('start-of-file')
-            self.sender(content)
+            self.sender(commands)
             self.echo_back('end-of-file')
 
     def add_tab_to_config(self, ui):
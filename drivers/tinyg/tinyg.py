@@ -7,10 +7,12 @@ import urllib2
 import datetime
 from configuration import conf
 from controller_board import ControllerBoard
+import preflight
 from pubsub import pub
 from PyQt4 import QtGui
 from functools import partial
 import json
+import patterns
 
 
 class TinyG(ControllerBoard):
@@ -20,10 +22,35 @@ class TinyG(ControllerBoard):
 
     board_config = {}
     command_queue_slots = 28
+    rx_buffer_size = 254
 
     reset_pending = False
     board_name = 'TinyG 0.96'
     default_firmware_branch_name = 'master'
+    firmware_version = 0.96
+
+    simulator = None
+    simulator_port_name = 'simulator'
+
+    # board settings the preflight count and time estimate depend on
+    planner_setting_ids = ['ct', 'ja'] + [
+        axis_letter + setting_id
+        for axis_letter in ['x', 'y', 'z']
+        for setting_id in ['vm', 'fr', 'jm', 'jd']]
+
+    # jerk settings are reported in mm/min^3
+    jerk_multiplier = 1
+
+    # parsers interested in each top level key of a json response, in the
+    # order they run, names are looked up so drivers can override them
+    response_parsers = [
+        ('msg', 'parse_reset'),
+        ('qr', 'parse_queue_report'),
+        ('err', 'parse_queue_report'),
+        ('sr', 'parse_position'),
+        ('er', 'parse_errors'),
+        ('sr', 'parse_status'),
+        ('msg', 'parse_echo')]
 
     def __init__(self, main_window):
         super(TinyG, self).__init__(main_window)
@@ -31,6 +58,7 @@ class TinyG(ControllerBoard):
 
     # event handlers
     def reset_received_handler(self):
+        super(TinyG, self).reset_received_handler()
         return True
 
     def is_connected(self, port, baud, stopbits, parity, flow):
@@ -86,11 +114,15 @@ class TinyG(ControllerBoard):
             ' @ ' + str(conf.get('connection.port.baud')))
         self.main_window.set_comm_status('Connecting')
 
+        port_name = conf.get('connection.port.name')
+        if port_name == self.simulator_port_name:
+            port_name = self.start_simulator()
+
         use_rtscts = (conf.get('connection.port.flow_control') == 'rtscts')
         use_xonxoff = (conf.get('connection.port.flow_control') == 'xonxoff')
         try:
             self.port = serial.Serial(
-                conf.get('connection.port.name'),
+                port_name,
                 int(conf.get('connection.port.baud')),
                 timeout=int(conf.get('connection.port.read_timeout')),
                 writeTimeout=int(conf.get('connection.port.write_timeout')),
@@ -120,6 +152,20 @@ class TinyG(ControllerBoard):
 
         return False
 
+    def start_simulator(self):
+        if self.simulator is None:
+            # the simulator needs a pseudo terminal, only imported when it
+            # is asked for so the driver still loads where there are none
+            from tinyg_simulator import TinyGSimulator
+            self.simulator = TinyGSimulator(
+                version=self.firmware_version,
+                baud=int(conf.get('connection.port.baud')))
+            self.simulator.start()
+            self.logger.debug(
+                'Started TinyG simulator on ' + self.simulator.port_name)
+
+        return self.simulator.port_name
+
     def enable_json_mode(self):
         command = '$ej=1'
         if conf.get('common.add_gcode_comments_for_system_commands'):
@@ -138,19 +184,8 @@ class TinyG(ControllerBoard):
 
     def parse_config(self, line):
         # match config information
-        # ([\d\.\-\w]+)(.{0})                       2X2660-FHZ
-        # ([\d+\.]+) ((?:\[)[^\]]+(?:\]))         1 [standard]
-        # ([\d+\.]+) (\w+\/\w+(?:\^\d))           500000000.0 mm/min^3
-        # ([\d+\.]+) (\w{2,3}).*                  0.0100 mm (larger is faster)
-        patterns = [
-            '([\d\.\-\w]+)(.{0})',
-            '([\d+\.]+) (?:\[)([^\]]+)(?:\])',
-            '([\d+\.]+) (\w+\/\w+(?:\^\d))',
-            '([\d\-\.]+) (\w{2,3}).*']
-        for pattern in patterns:
-            config_re = re.compile(
-                '^\[([^\]]+)\] +([\w ]{0,10}[a-zA-Z ]+) ' + pattern + '$')
-            match = re.search(config_re, line)
+        for config_pattern in patterns.tinyg_config:
+            match = config_pattern.search(line)
             if match is not None:
                 groups = tuple(filter(None, match.groups()))
                 try:
@@ -181,10 +216,7 @@ class TinyG(ControllerBoard):
             self.logger.debug('queue_size: ' + str(queue_size))
 
             if self.sender_thread is not None:
-                if free_queue_slots > 1:
-                    self.sender_thread.ready.emit()
-                else:
-                    self.sender_thread.block.emit()
+                self.sender_thread.set_clear_to_send(free_queue_slots > 1)
 
             pub.sendMessage('queue-size', size=queue_size)
 
@@ -192,6 +224,40 @@ class TinyG(ControllerBoard):
 
         return True
 
+    def arc_slot_counter(self):
+        # 0.96 cuts every arc into chords of the same length
+        return preflight.ChordArcSlots()
+
+    def planner_settings(self):
+        return tuple(
+            self.board_config[setting_id]['value']
+            if setting_id in self.board_config else None
+            for setting_id in self.planner_setting_ids)
+
+    def planner_limits(self):
+        if any(setting_id not in self.board_config
+               for setting_id in self.planner_setting_ids[1:]):
+            return None
+
+        limits = {
+            'junction_acceleration': float(self.board_config['ja']['value']),
+            'velocity': {},
+            'feed': {},
+            'jerk': {},
+            'junction_deviation': {}}
+        for axis_letter in ['x', 'y', 'z']:
+            limits['velocity'][axis_letter] = float(
+                self.board_config[axis_letter + 'vm']['value'])
+            limits['feed'][axis_letter] = float(
+                self.board_config[axis_letter + 'fr']['value'])
+            limits['jerk'][axis_letter] = float(
+                self.board_config[axis_letter + 'jm']['value']) * \
+                self.jerk_multiplier
+            limits['junction_deviation'][axis_letter] = float(
+                self.board_config[axis_letter + 'jd']['value'])
+
+        return limits
+
     def parse_position(self, response):
         if 'sr' in response:
             for axis_letter in ['x', 'y', 'z']:
@@ -199,19 +265,16 @@ class TinyG(ControllerBoard):
                     coordinate = response['sr']['pos' + axis_letter]
                     self.logger.debug(
                         'Stat: ' + axis_letter + ':' + str(coordinate))
-                    pub.sendMessage(
-                        'position-received',
-                        axis_letter=axis_letter,
-                        position=float(coordinate))
+                    self.machine_state.set_position(
+                        axis_letter, float(coordinate))
 
                     if self.track_coordinates:
-                        conf.set(
-                            'last_positions.' + axis_letter.lower(),
-                            float(coordinate))
+                        self.position_journal.record(
+                            axis_letter.lower(), float(coordinate))
 
             if 'vel' in response['sr']:
-                pub.sendMessage(
-                    'velocity-received', velocity=int(response['sr']['vel']))
+                self.machine_state.update(
+                    velocity=int(response['sr']['vel']))
 
             return False
 
@@ -283,19 +346,19 @@ class TinyG(ControllerBoard):
     def parse_echo(self, response):
         # trigger an echo back event
         if 'msg' in response:
-            session_re = re.compile('_' + self.session_id + '_')
-            match = re.search(session_re, response['msg'])
+            match = self.session_pattern.search(response['msg'])
 
             if match is not None:
                 pub.sendMessage(
-                    re.sub(session_re, '', response['msg']) + '-received')
+                    self.session_pattern.sub('', response['msg']) +
+                    '-received')
                 return False
 
         return True
 
     # analyse requests to the board
-    def parse_request(self, line):
-        log = super(TinyG, self).parse_request(line)
+    def parse_request(self, line, tokens=None):
+        log = super(TinyG, self).parse_request(line, tokens)
 
         if line == '{"sr":""}':
             log = False
@@ -307,34 +370,35 @@ class TinyG(ControllerBoard):
         self.logger.debug('Parsing response: ' + line)
         log = True
 
-        try:
-            response = json.loads(line)
+        # only json responses and text mode config lines carry anything
+        if line.startswith('{'):
+            try:
+                response = json.loads(line)
+            except ValueError:
+                self.logger.debug('response wasn\'t json')
+                return log
 
             if isinstance(response, dict):
+                log = self.dispatch_response(response)
+        elif line.startswith('['):
+            log = self.parse_config(line)
 
-                if 'r' in response:
-                    response = response['r']
-
-                if len(response) == 0 or 'rx' in response or '' in response:
-                    log = False
-
-                log = self.parse_reset(response) and log
-
-                log = self.parse_queue_report(response) and log
-
-                log = self.parse_position(response) and log
-
-                log = self.parse_errors(response) and log
-
-                log = self.parse_status(response) and log
+        return log
 
-                log = self.parse_echo(response) and log
+    def dispatch_response(self, response):
+        log = True
+        if 'r' in response:
+            response = response['r']
 
-        except ValueError:
-            self.logger.debug('response wasn\'t json')
-            pass
+        if len(response) == 0 or 'rx' in response or '' in response:
+            log = False
 
-        log = self.parse_config(line) and log
+        # run each parser once, only when a key it handles is present
+        parsers = []
+        for key, parser in self.response_parsers:
+            if key in response and parser not in parsers:
+                parsers.append(parser)
+                log = getattr(self, parser)(response) and log
 
         return log
 
@@ -402,18 +466,17 @@ class TinyG(ControllerBoard):
 
         # notify of board units
         if 'gun' in self.board_config:
-            pub.sendMessage(
-                'units-received',
-                unit_mode=self.board_config['gun']['value'])
+            self.machine_state.update(
+                units=int(self.board_config['gun']['value']))
             self.set_units(
                 metric=(self.board_config['gun']['value'] == '1'),
                 imperial=(self.board_config['gun']['value'] == '0'))
 
         if 'gdi' in self.board_config and self.absolute is None:
             self.absolute = (self.board_config['gdi']['value'] == '0')
-            pub.sendMessage(
-                'dist-mode-received',
-                dist_mode=self.board_config['gdi']['value'])
+            self.machine_state.update(absolute=self.absolute)
+
+        self.publish_state_changes()
 
         # notify of home switches
         for axis_letter in self.possible_axis:
@@ -446,13 +509,19 @@ class TinyG(ControllerBoard):
         self.send(command)
         self.echo_back('config')
 
+    # the board answers every line it takes out of its receive buffer
+    # with a prompt in text mode or an 'r' response in json mode
+    def is_acknowledgement(self, line):
+        return line.startswith('{"r"') or \
+            patterns.tinyg_acknowledgement.search(line) is not None
+
     # this is a pre filter to just remove some lines
     def filter_response(self, line):
-        line = re.sub(r"^tinyg \[[^\]]+\] ok\>\s*", "", line)
+        line = patterns.tinyg_prompt.sub('', line)
         return line
 
-    def filter_request(self, line):
-        line = super(TinyG, self).filter_request(line)
+    def filter_request(self, line, rewriter=None):
+        line = super(TinyG, self).filter_request(line, rewriter)
 
         return line
 
@@ -2,11 +2,26 @@ import logging
 import re
 from configuration import conf
 from tinyg import TinyG
+import preflight
 from pubsub import pub
 
 
 class TinyG097(TinyG):
 
+    firmware_version = 0.97
+
+    # jerk settings are reported in millions of mm/min^3
+    jerk_multiplier = 1000000
+
+    def arc_slot_counter(self):
+        # chords are as long as they can be while staying within the
+        # chordal tolerance of the arc
+        if 'ct' not in self.board_config:
+            return super(TinyG097, self).arc_slot_counter()
+
+        return preflight.ChordArcSlots(
+            float(self.board_config['ct']['value']))
+
     def parse_queue_report(self, response):
         # check queue report and set/clear flag to send
         if 'qr' in response and 'qi' in response and 'qo' in response:
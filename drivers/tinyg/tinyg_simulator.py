@@ -0,0 +1,696 @@
+#!/usr/bin/python
+
+import os
+import re
+import pty
+import fcntl
+import tty
+import math
+import time
+import json
+import select
+import logging
+import argparse
+import threading
+from collections import deque
+
+
+class TinyGSimulator(threading.Thread):
+
+    """
+      A virtual TinyG on a pseudo terminal, it answers the commands sent
+      by the TinyG drivers closely enough to stream files through the
+      real sender without a machine on the bench
+    """
+
+    # id, message, value, units
+    default_config = [
+        ('fb', 'firmware build', '440.20', ''),
+        ('fv', 'firmware version', '0.970', ''),
+        ('hv', 'hardware version', '8', ''),
+        ('id', 'board ID', '2X2660-FHZ', ''),
+        ('ee', 'enable echo', '0', '[0=off,1=on]'),
+        ('ej', 'enable json mode', '0', '[0=text,1=JSON]'),
+        ('ex', 'enable flow control', '2', '[0=off,1=XON/XOFF,2=RTS/CTS]'),
+        ('qv', 'queue report verbosity', '1', '[0=off,1=single,2=triple]'),
+        ('sv', 'status report verbosity', '1', '[0=off,1=filtered,2=verbose]'),
+        ('si', 'status interval', '100', 'ms'),
+        ('ja', 'junction acceleration', '100000', 'mm'),
+        ('ct', 'chordal tolerance', '0.010', 'mm'),
+        ('gun', 'default gcode units mode', '1', '[0=inch,1=mm]'),
+        ('gdi', 'default gcode distance mode', '0', '[0=G90,1=G91]'),
+        ('1ma', 'm1 map to axis', '0', '[0=X,1=Y,2=Z...]'),
+        ('2ma', 'm2 map to axis', '1', '[0=X,1=Y,2=Z...]'),
+        ('3ma', 'm3 map to axis', '2', '[0=X,1=Y,2=Z...]'),
+        ('4ma', 'm4 map to axis', '3', '[0=X,1=Y,2=Z...]')]
+
+    axis_config = [
+        ('vm', 'velocity maximum', '16000', 'mm/min'),
+        ('fr', 'feedrate maximum', '16000', 'mm/min'),
+        ('jm', 'jerk maximum', '5000', 'mm/min^3'),
+        ('jd', 'junction deviation', '0.0500', 'mm'),
+        ('sn', 'switch min', '1', '[0=off,1=homing,2=limit,3=limit+homing]'),
+        ('sx', 'switch max', '0', '[0=off,1=homing,2=limit,3=limit+homing]'),
+        ('lb', 'latch backoff', '2.000', 'mm'),
+        ('zb', 'zero backoff', '1.000', 'mm')]
+
+    axis_letters = ['x', 'y', 'z', 'a']
+    realtime_characters = b'!~%\x18'
+
+    # TinyG stat values
+    stat_ready = 1
+    stat_stop = 3
+    stat_end = 4
+    stat_run = 5
+    stat_hold = 6
+
+    def __init__(
+            self, version=0.97, baud=115200, rx_buffer_size=254,
+            planner_depth=28, speed=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logging.getLogger(__name__)
+
+        self.version = float(version)
+        self.baud = int(baud)
+        self.rx_buffer_size = int(rx_buffer_size)
+        self.planner_depth = int(planner_depth)
+        self.speed = float(speed)
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        fcntl.fcntl(
+            self.master, fcntl.F_SETFL,
+            fcntl.fcntl(self.master, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.port_name = os.ttyname(self.slave)
+
+        self.running = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.config = {}
+        self.config_order = []
+        for config_id, message, value, units in self.default_config:
+            self.add_config(config_id, message, value, units)
+        for axis_letter in self.axis_letters:
+            for postfix, message, value, units in self.axis_config:
+                if axis_letter == 'a':
+                    units = units.replace('mm', 'deg')
+                self.add_config(
+                    axis_letter + postfix, axis_letter + ' ' + message,
+                    value, units)
+
+        self.config['fv']['value'] = '%.3f' % self.version
+        if self.version < 0.97:
+            self.config['fb']['value'] = '380.08'
+            self.config['jm']['value'] = '5000000000.0'
+
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.rx_credit = 0.0
+        self.tx_credit = 0.0
+        self.credit_time = time.time()
+
+        self.planner = deque([])
+        self.arc_segments = deque([])
+        self.move = None
+        self.move_start = 0
+        self.move_end = 0
+
+        self.position = dict((axis, 0.0) for axis in self.axis_letters)
+        self.move_origin = dict(self.position)
+        self.motion_mode = 0
+        self.feed_rate = 0.0
+        self.absolute = True
+        self.stat = self.stat_ready
+        self.held = False
+        self.held_time = 0
+
+        self.queue_changed = False
+        self.queued_in = 0
+        self.queued_out = 0
+        self.last_report = None
+        self.next_report = 0
+
+        # statistics for the benchmarks
+        self.lines_received = 0
+        self.bytes_received = 0
+        self.moves_executed = 0
+        self.first_motion_time = None
+        self.last_motion_time = None
+        self.starved_since = None
+        self.starved_time = 0.0
+        self.hold_time = None
+
+    def add_config(self, config_id, message, value, units):
+        self.config[config_id] = {
+            'message': message, 'value': value, 'units': units}
+        self.config_order.append(config_id)
+
+    def config_value(self, config_id):
+        return float(self.config[config_id]['value'])
+
+    def config_line(self, config_id):
+        config_item = self.config[config_id]
+        line = '[' + config_id + '] ' + config_item['message'].ljust(30) + \
+            ' ' + config_item['value']
+        if len(config_item['units']) > 0:
+            line += ' ' + config_item['units']
+
+        return line
+
+    def units(self):
+        if self.config['gun']['value'] == '0':
+            return 'in'
+        return 'mm'
+
+    def run(self):
+        self.running = True
+        while self.running:
+            now = time.time()
+            timeout = self.next_event(now)
+
+            # only wait on the port when the line has credit to carry bytes
+            reading = []
+            if self.rx_credit >= 1 and len(self.rx) < self.rx_buffer_size:
+                reading = [self.master]
+            writing = []
+            if len(self.tx) > 0 and self.tx_credit >= 1:
+                writing = [self.master]
+            try:
+                readable = select.select(reading, writing, [], timeout)[0]
+            except (select.error, ValueError):
+                break
+
+            now = time.time()
+            with self.lock:
+                self.add_credit(now)
+                if len(readable) > 0:
+                    self.read_input(now)
+                self.parse_lines(now)
+                self.execute(now)
+                self.parse_lines(now)
+                self.report(now)
+                self.write_output()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.stop()
+        for fileno in [self.master, self.slave]:
+            try:
+                os.close(fileno)
+            except OSError:
+                pass
+
+    # serial pacing
+    def byte_time(self):
+        if self.baud <= 0:
+            return 0
+        return 10.0 / self.baud
+
+    def add_credit(self, now):
+        # bytes the line could have carried since we last looked, capped
+        # so an idle line can't save up more than a short burst
+        elapsed = now - self.credit_time
+        self.credit_time = now
+        if self.baud <= 0:
+            self.rx_credit = self.tx_credit = float(self.rx_buffer_size)
+            return
+
+        burst = 64.0
+        carried = elapsed / self.byte_time()
+        self.rx_credit = min(burst, self.rx_credit + carried)
+        self.tx_credit = min(burst, self.tx_credit + carried)
+
+    def next_event(self, now):
+        events = [now + 1.0]
+        if self.move is not None and not self.held:
+            events.append(self.move_end)
+        if self.stat == self.stat_run:
+            events.append(self.next_report)
+        if self.rx_credit < 1 or (len(self.tx) > 0 and self.tx_credit < 1):
+            events.append(now + self.byte_time())
+
+        return max(0, min(events) - now)
+
+    def read_input(self, now):
+        room = self.rx_buffer_size - len(self.rx)
+        size = int(min(room, self.rx_credit))
+        if size <= 0:
+            return
+
+        try:
+            data = os.read(self.master, size)
+        except OSError:
+            return
+
+        self.rx_credit -= len(data)
+        self.bytes_received += len(data)
+        realtime_characters = bytearray(self.realtime_characters)
+        for character in bytearray(data):
+            if character in realtime_characters:
+                self.realtime_command(chr(character), now)
+            else:
+                self.rx.append(character)
+
+    def write_output(self):
+        size = int(min(len(self.tx), self.tx_credit))
+        if size <= 0:
+            return
+
+        try:
+            written = os.write(self.master, bytes(self.tx[:size]))
+        except OSError:
+            return
+
+        self.tx_credit -= written
+        del self.tx[:written]
+
+    def respond(self, text):
+        self.tx.extend((text + '\n').encode('ascii'))
+
+    def respond_json(self, response):
+        self.respond(json.dumps(response, separators=(',', ':')))
+
+    def respond_footer(self, response, length):
+        # the board always leads with the response and ends with the footer
+        self.respond(
+            '{"r":' + json.dumps(response, separators=(',', ':')) +
+            ',"f":[1,0,' + str(length) + ',0]}')
+
+    def acknowledge(self, line, response=None):
+        if self.config['ej']['value'] == '1' or response is not None:
+            if response is None:
+                response = {}
+            self.respond_footer(response, len(line) + 1)
+        else:
+            self.respond('tinyg [' + self.units() + '] ok> ')
+
+    # realtime characters are acted on as soon as they arrive
+    def realtime_command(self, character, now):
+        if character == '!':
+            self.held = True
+            self.held_time = now
+            self.hold_time = now
+            self.set_stat(self.stat_hold, now)
+        elif character == '~':
+            if self.held:
+                self.held = False
+                if self.move is not None:
+                    self.move_end += now - self.held_time
+                    self.move_start += now - self.held_time
+            self.set_stat(self.running_stat(), now)
+        elif character == '%':
+            # a flush during a hold also drops the rest of the current move
+            if self.held and self.move is not None:
+                self.position = self.current_position(now)
+                self.move = None
+            self.planner = deque([])
+            self.arc_segments = deque([])
+            self.queue_changed = True
+        elif character == '\x18':
+            self.reset()
+            self.respond_footer({
+                'fv': self.version,
+                'fb': float(self.config['fb']['value']),
+                'msg': 'SYSTEM READY'}, 1)
+
+    def running_stat(self):
+        if self.move is not None or len(self.planner) > 0:
+            return self.stat_run
+        return self.stat_stop
+
+    def set_stat(self, stat, now):
+        if stat != self.stat:
+            self.stat = stat
+            self.status_report(now)
+
+    # command parsing
+    def parse_lines(self, now):
+        while len(self.arc_segments) > 0 and \
+                len(self.planner) < self.planner_depth:
+            self.queue(self.arc_segments.popleft())
+
+        while len(self.arc_segments) == 0 and \
+                len(self.planner) < self.planner_depth:
+            end = self.rx.find(b'\n')
+            if end < 0:
+                # a full buffer without a newline is taken as a line
+                if len(self.rx) < self.rx_buffer_size:
+                    break
+                end = len(self.rx)
+
+            line = bytes(self.rx[:end]).decode('ascii', 'ignore')
+            del self.rx[:end + 1]
+            self.lines_received += 1
+            self.parse_line(line.strip(), now)
+
+    def parse_line(self, line, now):
+        if line.startswith('{'):
+            self.parse_json(line)
+        elif line.startswith('$'):
+            self.parse_setting(line)
+        else:
+            self.parse_gcode(line, now)
+
+    def parse_json(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            self.acknowledge(line)
+            return
+
+        response = {}
+        for key, value in request.items():
+            if key == 'sr':
+                response['sr'] = self.status()
+            elif key == 'msg':
+                response['msg'] = value
+            elif key == 'qr':
+                response['qr'] = self.planner_depth - len(self.planner)
+            elif key in self.config:
+                if value != '':
+                    self.config[key]['value'] = str(value)
+                response[key] = self.json_value(key)
+
+        self.acknowledge(line, response)
+
+    def json_value(self, config_id):
+        value = self.config[config_id]['value']
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+    def parse_setting(self, line):
+        command = re.sub(r'\(.*\)', '', line[1:]).strip().lower()
+        if command == '$':
+            for config_id in self.config_order:
+                self.respond(self.config_line(config_id))
+        elif command == 'qr':
+            self.respond_json(
+                {'qr': self.planner_depth - len(self.planner)})
+        elif '=' in command:
+            config_id, value = command.split('=', 1)
+            if config_id in self.config:
+                self.config[config_id]['value'] = value.strip()
+                self.respond(self.config_line(config_id))
+        elif command in self.config:
+            self.respond(self.config_line(command))
+
+        self.acknowledge(line)
+
+    def parse_gcode(self, line, now):
+        words = re.findall(
+            r'([A-Za-z])\s*([\-\+]?[\d\.]+)',
+            re.sub(r'\([^\)]*\)|;.*$', '', line))
+        values = {}
+        codes = []
+        for letter, value in words:
+            letter = letter.upper()
+            if letter in 'GM':
+                codes.append(letter + ('%g' % float(value)))
+            else:
+                values[letter] = float(value)
+
+        target = dict(self.position)
+        for code in codes:
+            if code in ['G0', 'G1', 'G2', 'G3']:
+                self.motion_mode = int(code[1:])
+            elif code == 'G90':
+                self.absolute = True
+            elif code == 'G91':
+                self.absolute = False
+            elif code in ['G92', 'G28.2', 'G28.3']:
+                for axis_letter in self.axis_letters:
+                    if axis_letter.upper() in values:
+                        self.position[axis_letter] = 0.0
+                        if code == 'G92':
+                            self.position[axis_letter] = \
+                                values[axis_letter.upper()]
+                self.acknowledge(line)
+                return
+            elif code == 'G4':
+                self.queue({
+                    'target': target, 'duration': values.get('P', 0)})
+            elif code[0] == 'M':
+                self.queue({'target': target, 'duration': 0})
+
+        if 'F' in values:
+            self.feed_rate = values['F']
+
+        moving = False
+        for axis_letter in self.axis_letters:
+            if axis_letter.upper() in values:
+                moving = True
+                if self.absolute:
+                    target[axis_letter] = values[axis_letter.upper()]
+                else:
+                    target[axis_letter] += values[axis_letter.upper()]
+
+        if moving:
+            if self.motion_mode in [2, 3]:
+                self.queue_arc(target, values)
+            else:
+                self.queue_line(target)
+
+        self.acknowledge(line)
+
+    # planning and execution
+    def rate(self):
+        if self.motion_mode == 0 or self.feed_rate <= 0:
+            return self.config_value('xvm')
+        return min(self.feed_rate, self.config_value('xfr'))
+
+    def queue_line(self, target):
+        self.queue({
+            'target': target,
+            'motion': True,
+            'duration': self.distance(self.planned_position(), target) /
+            self.rate() * 60})
+
+    def queue_arc(self, target, values):
+        start = self.planned_position()
+        if 'R' in values:
+            radius = abs(values['R'])
+            chord = self.distance(start, target, ['x', 'y'])
+            angle = 2 * math.asin(min(1.0, chord / (2 * radius)))
+        else:
+            centre_x = start['x'] + values.get('I', 0)
+            centre_y = start['y'] + values.get('J', 0)
+            radius = math.hypot(
+                start['x'] - centre_x, start['y'] - centre_y)
+            start_angle = math.atan2(
+                start['y'] - centre_y, start['x'] - centre_x)
+            end_angle = math.atan2(
+                target['y'] - centre_y, target['x'] - centre_x)
+            angle = end_angle - start_angle
+            if self.motion_mode == 2:
+                angle = -angle
+            if angle <= 0:
+                angle += 2 * math.pi
+
+        length = math.hypot(angle * radius, target['z'] - start['z'])
+        segments = self.arc_segment_count(radius, length)
+
+        # chords are fed into the planner as slots become free
+        for segment in range(1, segments + 1):
+            fraction = float(segment) / segments
+            point = dict(
+                (axis, start[axis] + (target[axis] - start[axis]) * fraction)
+                for axis in self.axis_letters)
+            self.arc_segments.append({
+                'target': point,
+                'motion': True,
+                'duration': length / segments / self.rate() * 60})
+
+    def arc_segment_count(self, radius, length):
+        if self.version >= 0.97:
+            tolerance = min(self.config_value('ct'), radius)
+            segment_length = 2 * math.sqrt(
+                max(tolerance * (2 * radius - tolerance), 1e-9))
+        else:
+            segment_length = 0.1
+
+        # segments are never shorter than 10ms at the programmed feed
+        by_time = (length / self.rate()) * 60 / 0.01
+        return max(1, int(min(length / segment_length, by_time)))
+
+    def planned_position(self):
+        if len(self.arc_segments) > 0:
+            return self.arc_segments[-1]['target']
+        if len(self.planner) > 0:
+            return self.planner[-1]['target']
+        if self.move is not None:
+            return self.move['target']
+        return self.position
+
+    def distance(self, start, end, axes=None):
+        if axes is None:
+            axes = ['x', 'y', 'z']
+        return math.sqrt(sum((end[axis] - start[axis]) ** 2 for axis in axes))
+
+    def queue(self, move):
+        self.planner.append(move)
+        self.queued_in += 1
+        self.queue_changed = True
+
+    def execute(self, now):
+        if self.held:
+            return
+
+        while True:
+            if self.move is not None:
+                if now < self.move_end:
+                    return
+
+                self.position = dict(self.move['target'])
+                self.move = None
+                self.moves_executed += 1
+                self.last_motion_time = self.move_end
+
+            if len(self.planner) == 0 and len(self.arc_segments) > 0:
+                self.queue(self.arc_segments.popleft())
+
+            if len(self.planner) == 0:
+                if self.starved_since is None:
+                    self.starved_since = self.last_motion_time
+                self.set_stat(self.stat_stop, now)
+                return
+
+            # back to back moves start where the last one finished
+            start = now
+            if self.last_motion_time is not None:
+                start = max(self.last_motion_time, now - 0.01)
+            if self.starved_since is not None:
+                self.starved_time += max(0, start - self.starved_since)
+                self.starved_since = None
+
+            self.move = self.planner.popleft()
+            if self.first_motion_time is None and 'motion' in self.move:
+                self.first_motion_time = now
+            self.move_origin = dict(self.position)
+            self.queued_out += 1
+            self.queue_changed = True
+
+            duration = 0
+            if self.speed > 0:
+                duration = self.move['duration'] / self.speed
+            self.move_start = start
+            self.move_end = start + duration
+            self.set_stat(self.stat_run, now)
+
+    def current_position(self, now):
+        if self.move is None or self.move_end <= self.move_start:
+            return self.position
+
+        if self.held:
+            now = self.held_time
+        fraction = min(
+            1.0, max(0.0, (now - self.move_start) /
+                     (self.move_end - self.move_start)))
+        return dict(
+            (axis, self.move_origin[axis] +
+             (self.move['target'][axis] - self.move_origin[axis]) *
+             fraction)
+            for axis in self.axis_letters)
+
+    # reports
+    def status(self, now=None):
+        if now is None:
+            now = time.time()
+
+        position = self.current_position(now)
+        velocity = 0
+        if self.move is not None and not self.held and \
+                self.move['duration'] > 0:
+            velocity = int(
+                self.distance(self.move_origin, self.move['target']) /
+                self.move['duration'] * 60)
+
+        return {
+            'posx': round(position['x'], 3),
+            'posy': round(position['y'], 3),
+            'posz': round(position['z'], 3),
+            'posa': round(position['a'], 3),
+            'vel': velocity,
+            'stat': self.stat}
+
+    def status_report(self, now):
+        self.next_report = now + self.config_value('si') / 1000
+        status = self.status(now)
+        if self.config['sv']['value'] == '1' and \
+                self.last_report is not None:
+            # filtered reports only carry what changed
+            changed = {}
+            for key in status:
+                if self.last_report.get(key) != status[key]:
+                    changed[key] = status[key]
+            self.last_report = status
+            if len(changed) == 0:
+                return
+            status = changed
+        else:
+            self.last_report = status
+
+        if self.config['sv']['value'] != '0':
+            self.respond_json({'sr': status})
+
+    def report(self, now):
+        if self.queue_changed:
+            self.queue_changed = False
+            free = self.planner_depth - len(self.planner)
+            if self.config['qv']['value'] == '2':
+                self.respond_json({
+                    'qr': free, 'qi': self.queued_in, 'qo': self.queued_out})
+            elif self.config['qv']['value'] == '1':
+                self.respond_json({'qr': free})
+            self.queued_in = 0
+            self.queued_out = 0
+
+        if self.stat == self.stat_run and now >= self.next_report:
+            self.status_report(now)
+
+    def statistics(self):
+        with self.lock:
+            return {
+                'lines_received': self.lines_received,
+                'bytes_received': self.bytes_received,
+                'moves_executed': self.moves_executed,
+                'first_motion_time': self.first_motion_time,
+                'last_motion_time': self.last_motion_time,
+                'starved_time': self.starved_time,
+                'hold_time': self.hold_time,
+                'idle': (self.move is None and len(self.planner) == 0 and
+                         len(self.arc_segments) == 0)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a virtual TinyG on a pseudo terminal')
+    parser.add_argument('--version', type=float, default=0.97)
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--planner-depth', type=int, default=28)
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='execution speed multiplier, 0 executes moves instantly')
+    args = parser.parse_args()
+
+    simulator = TinyGSimulator(
+        version=args.version, baud=args.baud,
+        planner_depth=args.planner_depth, speed=args.speed)
+    simulator.start()
+    print('TinyG ' + str(args.version) + ' simulator on ' +
+          simulator.port_name)
+
+    try:
+        while simulator.is_alive():
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        simulator.close()
+
+if __name__ == '__main__':
+    main()
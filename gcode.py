@@ -0,0 +1,376 @@
+import re
+import patterns
+
+# lines starting with these are system commands and realtime characters
+command_characters = '{$%!~?\x18'
+
+# decimal places kept for the numbers of each word when precision is
+# restricted, a ten thousandth of the unit for linear axes, arc words and
+# dwells and of a feed rate, which in G93 inverse time mode is often a small
+# fraction, a thousandth of a degree for rotary axes, words not listed here
+# are never rewritten
+word_decimals = {
+    'X': 4, 'Y': 4, 'Z': 4, 'I': 4, 'J': 4, 'K': 4, 'R': 4, 'P': 4,
+    'A': 3, 'B': 3, 'C': 3, 'F': 4}
+
+# words that are left as they are rather than rounded to zero, a zero feed
+# rate is rejected where the one written was not
+nonzero_words = 'Ff'
+
+
+def read_lines(file_path):
+    # yield the lines of a g-code file one at a time without loading it,
+    # only the newline is removed, the same as splitting the contents
+    with open(file_path, 'rb') as f:
+        for line in f:
+            if line.endswith(b'\n'):
+                line = line[:-1]
+            yield line
+
+
+def tokenize(line):
+    # split a line of g-code into (letter, value) words with one pass of a
+    # compiled pattern, comments and system commands have no words
+    if len(line) == 0 or line[0] in command_characters:
+        return []
+
+    return [
+        word for word in patterns.gcode_token.findall(line.upper())
+        if word[0]]
+
+
+def codes(tokens, letter):
+    # the numeric values of every word with the given letter
+    values = []
+    for word, value in tokens:
+        if word == letter:
+            try:
+                values.append(float(value))
+            except ValueError:
+                pass
+
+    return values
+
+
+def words(tokens):
+    # the numeric values of the words on a line by letter, the same as
+    # calling codes for every letter but in one pass over the tokens
+    values = {}
+    for word, value in tokens:
+        try:
+            number = float(value)
+        except ValueError:
+            continue
+        if word in values:
+            values[word].append(number)
+        else:
+            values[word] = [number]
+
+    return values
+
+
+class NumberRewriter(object):
+
+    """
+      rewrites the numbers of the words in word_decimals to the fewest
+      characters that keep their precision, rounding off extra decimals,
+      dropping trailing zeros and plus signs and turning -0 into 0, and
+      counts the bytes it saves
+    """
+
+    def __init__(self, decimals=None):
+        if decimals is None:
+            decimals = word_decimals
+        self.decimals = {}
+        for letter, places in decimals.items():
+            self.decimals[letter.upper()] = places
+            self.decimals[letter.lower()] = places
+        letters = ''.join(sorted(self.decimals))
+        # comments are matched so that their contents are skipped
+        self.pattern = re.compile(
+            r'\([^)]*\)?|;.*|([' + letters +
+            r'])\s*([-+]?)(\d*)(?:\.(\d*))?')
+        self.bytes_saved = 0
+
+    def rewrite_word(self, match):
+        letter, sign, integer, fraction = match.groups()
+        if letter is None or not (integer or fraction):
+            return match.group(0)
+        if fraction is None:
+            fraction = ''
+
+        # rounded half away from zero on the digits themselves, so nothing
+        # is lost to binary floating point
+        places = self.decimals[letter]
+        if len(fraction) > places:
+            if fraction[places] < '5':
+                fraction = fraction[:places]
+            else:
+                digits = str(int(integer + fraction[:places] or '0') + 1)
+                if len(digits) <= places:
+                    digits = digits.rjust(places, '0')
+                    integer = integer and '0'
+                else:
+                    integer = digits[:len(digits) - places]
+                fraction = digits[len(digits) - places:]
+
+        fraction = fraction.rstrip('0')
+        if letter in nonzero_words and (integer + fraction).strip('0') == '' \
+                and (match.group(3) + (match.group(4) or '')).strip('0'):
+            return match.group(0)
+        if sign == '+' or (sign == '-' and fraction == '' and
+                           integer.strip('0') == ''):
+            sign = ''
+
+        if fraction:
+            return letter + sign + integer + '.' + fraction
+        if integer:
+            return letter + sign + integer
+
+        return letter + '0'
+
+    def rewrite(self, line):
+        # lines without a decimal point or a sign are already as short as
+        # they get
+        if len(line) == 0 or line[0] in command_characters or \
+                ('.' not in line and '+' not in line and '-' not in line):
+            return line
+
+        rewritten = self.pattern.sub(self.rewrite_word, line)
+        self.bytes_saved += len(line) - len(rewritten)
+
+        return rewritten
+
+
+# the modal setting each g code the minimizer follows sets, units and
+# distance mode the way parse_request and parse_distance_mode keep them
+modal_codes = {
+    0: ('motion', 0), 1: ('motion', 1), 2: ('motion', 2), 3: ('motion', 3),
+    17: ('plane', 17), 18: ('plane', 18), 19: ('plane', 19),
+    20: ('units', 0), 21: ('units', 1),
+    90: ('absolute', True), 91: ('absolute', False),
+    93: ('feed_mode', 93), 94: ('feed_mode', 94)}
+
+# everything the minimizer follows, forgotten together
+modal_names = [
+    'motion', 'plane', 'units', 'absolute', 'feed_mode', 'feed_rate']
+
+# spindle and coolant m codes, they leave the followed groups alone
+plain_m_codes = [3, 4, 5, 7, 8, 9]
+
+
+class ModalMinimizer(object):
+
+    """
+      shortens the lines of a file to the words that change something,
+      motion, plane, unit, distance and feed mode words and feed rates
+      already in force are dropped along with spaces and comments other
+      than messages, which stay where they were among the words, the state
+      starts out unknown and is forgotten after any line the minimizer does
+      not fully understand, which is then only stripped of spaces and
+      comments
+
+      the modes are followed here rather than in the controller's machine
+      state, which is only updated as lines are reported sent, well behind
+      the lines the sender is minimizing, and the board's modes can change
+      between files without a line being sent, so a file never starts
+      from what the controller's state says
+    """
+
+    def __init__(self):
+        self.state = dict.fromkeys(modal_names)
+        self.bytes_saved = 0
+
+    def reset(self):
+        self.state = dict.fromkeys(modal_names)
+
+    def redundant(self, words, changes):
+        # the words on a line that only repeat the state already in force,
+        # a feed rate is only the same feed rate in the same units and in
+        # units per minute, where it carries over from line to line,
+        # messages have no letter and are never dropped
+        state = self.state
+        counts = {}
+        for letter, value, number in words:
+            if letter == 'G':
+                name = modal_codes[number][0]
+                counts[name] = counts.get(name, 0) + 1
+            elif letter == 'F':
+                counts['feed_rate'] = counts.get('feed_rate', 0) + 1
+
+        repeated = set()
+        for name, value in changes.items():
+            if counts[name] == 1 and state[name] == value:
+                repeated.add(name)
+        if 'feed_rate' in repeated and (
+                changes.get('units', state['units']) != state['units'] or
+                93 in (changes.get('feed_mode'), state['feed_mode'])):
+            repeated.remove('feed_rate')
+
+        return [
+            index for index, (letter, value, number) in enumerate(words)
+            if (letter == 'G' and modal_codes[number][0] in repeated) or
+            (letter == 'F' and 'feed_rate' in repeated)]
+
+    def minimize(self, line):
+        if len(line) == 0 or line[0] in command_characters:
+            return line
+
+        words = []
+        position = 0
+        for match in patterns.minimizer_word.finditer(line):
+            comment, letter, value = match.groups()
+            if match.start() != position or (letter is not None and not any(
+                    character.isdigit() for character in value)):
+                break
+            position = match.end()
+            if letter is not None:
+                words.append((letter.upper(), value, float(value)))
+            elif comment is not None and \
+                    patterns.message_comment.match(comment) is not None:
+                words.append((None, comment, None))
+
+        # anything else on the line, such as a parameter or an expression,
+        # could change what the words mean
+        if position != len(line):
+            self.reset()
+            return line
+
+        changes = {}
+        understood = True
+        for letter, value, number in words:
+            if letter == 'G':
+                if number in modal_codes:
+                    name, setting = modal_codes[number]
+                    changes[name] = setting
+                else:
+                    understood = False
+            elif letter == 'M' and number not in plain_m_codes:
+                understood = False
+            elif letter == 'F':
+                changes['feed_rate'] = number
+
+        if understood:
+            dropped = self.redundant(words, changes)
+            if len(dropped) < len(
+                    [word for word in words if word[0] is not None]):
+                words = [
+                    word for index, word in enumerate(words)
+                    if index not in dropped]
+
+            # a feed rate set before means something else once the units
+            # or the feed mode change
+            for name in ['units', 'feed_mode']:
+                if name in changes and changes[name] != self.state[name]:
+                    self.state['feed_rate'] = None
+            self.state.update(changes)
+        else:
+            self.reset()
+
+        minimized = ''.join(
+            (letter or '') + value for letter, value, number in words)
+        self.bytes_saved += len(line) - len(minimized)
+
+        return minimized
+
+
+def minimize_lines(lines, minimizer=None):
+    # the minimized lines of a file, lines left with nothing to send, such
+    # as comments, are dropped
+    if minimizer is None:
+        minimizer = ModalMinimizer()
+
+    for line in lines:
+        line = minimizer.minimize(line)
+        if len(line) > 0:
+            yield line
+
+
+def command_slots(command, tokens=None):
+    # number of planner queue slots a command is expected to take up
+    if tokens is None:
+        tokens = tokenize(command)
+
+    if len(tokens) == 0 or tokens[0][0] not in 'MGTSF' or \
+            len(tokens[0][1]) == 0:
+        return 0
+
+    # add three more queue planner slots for archs, files are counted
+    # with their geometry by the preflight analysis instead
+    g_codes = codes(tokens, 'G')
+    if 2 in g_codes or 3 in g_codes:
+        return 4
+
+    return 1
+
+
+def split_words(lines):
+    # put every M, T and G word that follows a space on a line of its own
+    for line in lines:
+        if ' ' in line:
+            split = patterns.file_word_split.sub(r'\n\1', line)
+            for part in split.split('\n'):
+                yield part
+        else:
+            yield line
+
+
+def strip_comments(lines):
+    # a line holding only a comment is blanked, along with any blank lines
+    # directly after it
+    blanking = False
+    for line in lines:
+        if blanking:
+            if len(line.strip()) == 0:
+                continue
+            blanking = False
+            yield ''
+
+        if patterns.file_comment_line.match(line) is not None:
+            blanking = True
+        else:
+            yield line
+
+    if blanking:
+        yield ''
+
+
+def strip_blank_lines(lines):
+    # drop blank lines, apart from the first and last lines of the input
+    lines = iter(lines)
+    for line in lines:
+        yield line
+        break
+
+    blank = None
+    for line in lines:
+        if len(line.strip()) == 0:
+            blank = line
+        else:
+            blank = None
+            yield line
+
+    if blank is not None:
+        yield blank
+
+
+def filter_lines(lines):
+    # the line by line equivalent of ControllerBoard.filter_file, works on
+    # any iterable of lines without needing all of them up front
+    return strip_blank_lines(strip_comments(split_words(lines)))
+
+
+def process_lines(lines, filter_file=True, rewriter=None):
+    # the commands sent for some lines of a file, every line is processed
+    # on its own once blank lines are gone so a file can be split anywhere
+    # between lines and processed in parts, numbers are only rewritten
+    # when there is a rewriter
+    if filter_file:
+        lines = filter_lines(lines)
+
+    for line in lines:
+        command = line.strip()
+        if rewriter is not None:
+            command = rewriter.rewrite(command)
+        if len(command) > 0:
+            yield command
@@ -0,0 +1,39 @@
+class MachineState(object):
+
+    """
+      what the machine is doing as far as the lines sent to it and the
+      reports coming back from it tell, kept apart from the ui widgets so
+      the streaming path never has to touch them
+    """
+
+    def __init__(self):
+        self.spindle = False
+        self.spindle_direction = 0
+        self.spindle_speed = None
+        self.coolant = False
+        self.feed_rate = None
+        self.absolute = None
+        self.units = None
+        self.position = {}
+        self.velocity = 0
+        self.changes = {}
+
+    def update(self, **values):
+        # only values that differ from the current ones count as changes
+        for name, value in values.items():
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                self.changes[name] = value
+
+    def set_position(self, axis_letter, position):
+        if self.position.get(axis_letter) != position:
+            self.position[axis_letter] = position
+            self.changes.setdefault('position', {})[axis_letter] = position
+
+    def take_changes(self):
+        # hand over everything changed since the last call, a value that
+        # changed several times in between is only reported once
+        changes = self.changes
+        self.changes = {}
+
+        return changes
@@ -7,6 +7,7 @@ from PyQt4 import QtCore, QtGui, uic
 from configuration import conf
 
 from main_window import MainWindow
+import preprocess
 
 
 def main():
@@ -17,6 +18,9 @@ def main():
     logger = logging.getLogger(app_name.lower())
     logger.debug('Logging initialised')
 
+    # before anything starts a thread
+    preprocess.start_pool()
+
     app = QtGui.QApplication(sys.argv)
     logger.debug('Application initialised')
 
@@ -9,6 +9,7 @@ from PyQt4 import QtCore, QtGui, uic
 from math import isnan, floor, sqrt
 from configuration import conf
 from camera import Camera
+from console_model import ConsoleModel
 from pubsub import pub
 from functools import partial
 from options_window import OptionsWindow
@@ -27,6 +28,15 @@ class MainWindow(QtGui.QMainWindow):
 
         self.logger = logging.getLogger(__name__)
 
+        # positions and velocity are collected and shown at most
+        # ui.dro_refresh_rate times a second
+        self.dro_positions = {}
+        self.dro_velocity = None
+        self.dro_shown = {}
+        self.dro_timer = QtCore.QTimer(self)
+        self.dro_timer.setSingleShot(True)
+        self.dro_timer.timeout.connect(self.refresh_dro)
+
         driver_class_name = re.sub(
             r'[^a-zA-Z0-9]', '', conf.get('common.board_type'))
         driver_filename = re.sub(
@@ -49,21 +59,19 @@ class MainWindow(QtGui.QMainWindow):
                           driver_filename)
 
         self.logger.debug('Setting up controller to gui events')
-        pub.subscribe(self.position_received_handler, 'position-received')
-        pub.subscribe(self.velocity_received_handler, 'velocity-received')
         pub.subscribe(self.axis_received_handler, 'axis-received')
         pub.subscribe(self.home_received_handler, 'home-received')
         pub.subscribe(self.line_received_handler, 'line-received')
         pub.subscribe(self.line_sent_handler, 'line-sent')
         pub.subscribe(self.error_received_handler, 'error-received')
-        pub.subscribe(self.feed_rate_sent_handler, 'feed-rate-sent')
         pub.subscribe(self.reset_received_handler, 'reset-received')
-        pub.subscribe(self.units_received_handler, 'units-received')
-        pub.subscribe(self.dist_mode_received_handler, 'dist-mode-received')
+        pub.subscribe(
+            self.machine_state_changed_handler, 'machine-state-changed')
         pub.subscribe(self.connect_received_handler, 'connect-received')
         pub.subscribe(self.config_fetched_handler, 'config-fetched')
         pub.subscribe(self.disconnect_received_handler, 'disconnect-received')
         pub.subscribe(self.programme_progress_handler, 'programme-progress')
+        pub.subscribe(self.preflight_complete_handler, 'preflight-complete')
         pub.subscribe(self.queue_size_handler, 'queue-size')
         pub.subscribe(self.start_of_file_handler, 'start-of-file')
         pub.subscribe(self.end_of_file_handler, 'end-of-file')
@@ -96,10 +104,11 @@ class MainWindow(QtGui.QMainWindow):
 
     def restore_last_positions(self):
         for axis_letter in self.controller.installed_axis:
-            if conf.get('last_positions.' + axis_letter.lower()) is not None:
+            last_axis_position = self.controller.position_journal.get(
+                axis_letter.lower())
+            if last_axis_position is not None:
                 self.controller.reset_axis(
-                    axis_letter.upper(),
-                    conf.get('last_positions.' + axis_letter.lower()))
+                    axis_letter.upper(), last_axis_position)
 
     def config_fetched_handler(self):
         self.logger.debug('controller Config signal received')
@@ -138,13 +147,11 @@ class MainWindow(QtGui.QMainWindow):
                 self.ui, "lcdMachNumber" + axis_letter.upper())
 
             # add the axis and last known position to a dictionary
-            if conf.get('last_positions.' + axis_letter.lower()) is not None:
-                last_axis_position = conf.get(
-                    'last_positions.' +
-                    axis_letter.lower())
-                if lcdelement.value() != float(last_axis_position):
-                    positions[axis_letter.lower()] = conf.get(
-                        'last_positions.' + axis_letter.lower())
+            last_axis_position = self.controller.position_journal.get(
+                axis_letter.lower())
+            if last_axis_position is not None:
+                if lcdelement.value() != last_axis_position:
+                    positions[axis_letter.lower()] = last_axis_position
 
         # if there are axis that don't match the EPROM then prompt
         if len(positions) > 0:
@@ -174,7 +181,11 @@ controller to %s?
 
     def timer_tick_handler(self, total):
         # self.logger.debug('timer_tick_handler ' + str(total))
-        self.ui.lblOutputRuntime.setText(self.format_time(total))
+        runtime = self.format_time(total)
+        remaining = self.controller.remaining_time()
+        if remaining is not None:
+            runtime += ' (' + self.format_time(remaining) + ' left)'
+        self.ui.lblOutputRuntime.setText(runtime)
 
     def idle_handler(self):
         self.logger.debug('idle_handler')
@@ -219,10 +230,24 @@ controller to %s?
     def axis_received_handler(self, axis_letter):
         self.toggle_axis_visibility(axis_letter, True)
 
-    def position_received_handler(self, axis_letter, position):
-        self.update_lcd(axis_letter, position)
+    def refresh_dro(self):
+        # repaint the axes that moved since they were last shown
+        positions = self.dro_positions
+        self.dro_positions = {}
+        for axis_letter, position in positions.items():
+            if self.dro_shown.get(axis_letter) != position:
+                self.update_lcd(axis_letter, position)
+
+        if self.dro_velocity is not None:
+            self.show_velocity(self.dro_velocity)
+            self.dro_velocity = None
+
+    def schedule_dro_refresh(self):
+        if not self.dro_timer.isActive():
+            rate = max(1, int(conf.get('ui.dro_refresh_rate')))
+            self.dro_timer.start(1000 // rate)
 
-    def velocity_received_handler(self, velocity):
+    def show_velocity(self, velocity):
         # update the gui to show the current velocity
         self.ui.progressVelocity.setValue(
             min(velocity, self.ui.progressVelocity.maximum()))
@@ -232,30 +257,77 @@ controller to %s?
             ' actual:' +
             str(self.ui.progressVelocity.value()))
 
-    def feed_rate_sent_handler(self, rate):
+    def machine_state_changed_handler(self, changes):
+        # show what the controller's machine state says changed, signals
+        # are blocked so the widgets don't send the change straight back
+        if 'position' in changes or 'velocity' in changes:
+            self.dro_positions.update(changes.get('position', {}))
+            if 'velocity' in changes:
+                self.dro_velocity = changes['velocity']
+            self.schedule_dro_refresh()
+
+        if 'feed_rate' in changes:
+            self.show_feed_rate(changes['feed_rate'])
+
+        if 'units' in changes:
+            self.set_units(changes['units'])
+
+        if 'absolute' in changes:
+            self.logger.debug(
+                'distance mode changed ' + str(changes['absolute']))
+            self.set_dist_mode(int(not changes['absolute']))
+
+        if 'coolant' in changes:
+            self.ui.checkBoxCoolant.blockSignals(True)
+            self.ui.checkBoxCoolant.setChecked(changes['coolant'])
+            self.ui.checkBoxCoolant.blockSignals(False)
+
+        if 'spindle' in changes:
+            self.ui.checkBoxSpindle.blockSignals(True)
+            self.ui.checkBoxSpindle.setChecked(changes['spindle'])
+            self.ui.checkBoxSpindle.blockSignals(False)
+
+        if 'spindle_direction' in changes:
+            radio = self.ui.radioSpindleDirectionCW
+            if changes['spindle_direction'] == 1:
+                radio = self.ui.radioSpindleDirectionCCW
+            radio.blockSignals(True)
+            radio.setChecked(True)
+            radio.blockSignals(False)
+
+        if 'spindle_speed' in changes:
+            self.show_spindle_speed(changes['spindle_speed'])
+
+    def show_feed_rate(self, feed_rate):
         # add the feed rate to the gui and config
+        rate = '%g' % feed_rate
         index = self.ui.comboFeedRate.findText(rate)
         if index < 0:
-            items = []
+            items = [rate]
             for i in range(self.ui.comboFeedRate.count()):
-                items.append(self.ui.comboFeedRate.itemText(i))
-            items = sorted(items, key=int)
+                items.append(str(self.ui.comboFeedRate.itemText(i)))
+            items = sorted(items, key=float)
+            self.ui.comboFeedRate.blockSignals(True)
             self.ui.comboFeedRate.clear()
             self.ui.comboFeedRate.addItems(items)
-        index = self.ui.comboFeedRate.findText(rate)
+            self.ui.comboFeedRate.blockSignals(False)
+            index = items.index(rate)
         conf.set('ui.feed_rate_index', index)
         self.ui.comboFeedRate.setCurrentIndex(index)
 
+    def show_spindle_speed(self, speed):
+        speed = str(speed)
+        speed_index = self.ui.comboSpindleSpeed.findText(speed)
+        if speed_index < 0:
+            self.ui.comboSpindleSpeed.addItem(speed)
+            speed_index = self.ui.comboSpindleSpeed.count() - 1
+        self.ui.comboSpindleSpeed.blockSignals(True)
+        self.ui.comboSpindleSpeed.setCurrentIndex(speed_index)
+        self.ui.comboSpindleSpeed.blockSignals(False)
+
     def error_received_handler(self, state, message, value):
         self.show_error(state, message, value)
 
-    def units_received_handler(self, unit_mode):
-        self.set_units(unit_mode)
-
-    def dist_mode_received_handler(self, dist_mode):
-        self.logger.debug('dist_mode_received_handler ' + str(dist_mode))
-        self.set_dist_mode(dist_mode)
-
     def programme_progress_handler(self, progress):
         if self.ui.progressFileSend.value() < 100:
             self.logger.debug('programme_progress_handler ' + str(progress))
@@ -381,6 +453,14 @@ controller to %s?
         self.ui.textStatusArea.customContextMenuRequested.connect(
             self.context_menu_status)
 
+        # the console only holds the newest lines, the list view draws just
+        # the rows in sight
+        self.console_model = ConsoleModel(
+            int(conf.get('ui.console_lines')), self)
+        self.ui.textStatusArea.setModel(self.console_model)
+        self.console_model.rowsInserted.connect(
+            self.ui.textStatusArea.scrollToBottom)
+
         # set up some lists and default settings
         self.logger.debug('Adding step values')
         for stepdistance in [0.001, 0.01, 0.1, 1, 10, 100]:
@@ -555,10 +635,23 @@ controller to %s?
 
         clearAction.triggered.connect(self.clear_status_list)
         self.status_menu.addAction(clearAction)
+        saveAction = QtGui.QAction('Save As...', self)
+
+        saveAction.triggered.connect(self.save_status_list)
+        self.status_menu.addAction(saveAction)
         self.status_menu.popup(QtGui.QCursor.pos())
 
     def clear_status_list(self):
-        self.ui.textStatusArea.clear()
+        self.console_model.clear()
+
+    def save_status_list(self):
+        file_path = QtGui.QFileDialog.getSaveFileName(
+            self,
+            'Save Console',
+            conf.get('common.directory'),
+            'Log Files (*.log *.txt);;All Files (*.*)')
+        if file_path:
+            self.console_model.export(str(file_path))
 
     def goto(self, axis_letter, offset=False):
         coordinate = float(getattr(
@@ -741,6 +834,16 @@ controller to %s?
 
         if os.path.isfile(file_path):
             self.ui.btnStart.setEnabled(True)
+            self.controller.preflight(str(file_path))
+
+    def preflight_complete_handler(self, file_path, analysis):
+        if file_path != str(self.ui.lineFilePath.text()):
+            return
+
+        self.ui.lineFilePath.setToolTip(analysis.summary())
+        self.add_status_line(
+            '> ' + os.path.basename(file_path) + ': ' +
+            analysis.summary().split('\n')[0])
 
     def spindle_toggle(self):
         # filter and cast spindle speed
@@ -887,7 +990,7 @@ controller to %s?
         self.toggle_all_ui_elements(False)
 
     def add_status_line(self, line):
-        self.ui.textStatusArea.appendPlainText(line)
+        self.console_model.append(line)
 
     def set_comm_status(self, status_text):
         self.ui.lblBoardStatus.setText(status_text)
@@ -973,12 +1076,12 @@ controller to %s?
         self.logger.debug(
             'update_lcd ' + axis_letter + ' ' + str(position) + ' ' +
             str(only_offset))
+        lcd_format = "{0:." + str(conf.get('ui.lcd_precision')) + "f}"
         if not only_offset:
+            self.dro_shown[axis_letter] = position
             lcdelement = getattr(
                 self.ui, "lcdMachNumber" + axis_letter.upper())
-            lcdelement.display(
-                ("{0:." + str(conf.get('ui.lcd_precision')) + "f}")
-                .format(float(position)))
+            lcdelement.display(lcd_format.format(float(position)))
 
         offsetlcdelement = getattr(
             self.ui, "lcdWorkNumber" + axis_letter.upper())
@@ -993,8 +1096,7 @@ controller to %s?
             pass
 
         offsetlcdelement.display(
-            ("{0:." + str(conf.get('ui.lcd_precision')) + "f}")
-            .format(float(position) - float(offset)))
+            lcd_format.format(float(position) - float(offset)))
 
     def change_offset(self):
         conf.set('ui.current_offset_index', self.ui.comboOffset.currentIndex())
@@ -75,11 +75,14 @@ class OptionsWindow(QtGui.QDialog):
         # setup port combo box
         for port in self.fetch_ports():
             self.ui.cmbPort.addItem(port)
+        if self.main_window.controller.simulator_port_name is not None:
+            self.ui.cmbPort.addItem(
+                self.main_window.controller.simulator_port_name)
         self.ui.cmbPort.setCurrentIndex(
             self.ui.cmbPort.findText(conf.get('connection.port.name')))
 
-        self.ui.radioImperial.setChecked(conf.get('common.units') == '0')
-        self.ui.radioMetric.setChecked(conf.get('common.units') == '1')
+        self.ui.radioImperial.setChecked(conf.get('common.units') == 0)
+        self.ui.radioMetric.setChecked(conf.get('common.units') == 1)
 
         self.ui.radioSoft.setChecked(
             conf.get('connection.port.flow_control') == 'xonxoff')
@@ -125,9 +128,11 @@ class OptionsWindow(QtGui.QDialog):
             float(conf.get('ui.lcd_precision')))
 
         self.ui.chkFilterFileCommands.setChecked(
-            conf.get('common.filter_file_commands') == 'True')
+            conf.get('common.filter_file_commands'))
         self.ui.checkBoxReducePrecForLongLines.setChecked(
-            conf.get('common.restrict_file_precision') == 'True')
+            conf.get('common.restrict_file_precision'))
+        self.ui.chkMinimizeFileCommands.setChecked(
+            conf.get('common.minimize_file_commands'))
 
         # board config
         for key in sorted(self.main_window.controller.board_config):
@@ -312,10 +317,12 @@ class OptionsWindow(QtGui.QDialog):
         conf.set('ui.lcd_precision', int(self.ui.spinBoxLCDPrecision.value()))
 
         # filtering
-        conf.set('common.filter_file_commands', str(
-            self.ui.chkFilterFileCommands.isChecked()))
-        conf.set('common.restrict_file_precision', str(
-            self.ui.checkBoxReducePrecForLongLines.isChecked()))
+        conf.set('common.filter_file_commands',
+                 self.ui.chkFilterFileCommands.isChecked())
+        conf.set('common.restrict_file_precision',
+                 self.ui.checkBoxReducePrecForLongLines.isChecked())
+        conf.set('common.minimize_file_commands',
+                 self.ui.chkMinimizeFileCommands.isChecked())
 
         # board config
         for i in range(self.ui.configList.count()):
@@ -0,0 +1,46 @@
+import re
+
+# patterns run against every line sent to or received from a board, compiled
+# once here and shared by the controller base class and the drivers
+
+# whole file filtering
+file_word_split = re.compile(r' +([MTG])')
+file_comment_line = re.compile(r'^(\(|;)[^\)\n]*\)\s*$', re.MULTILINE)
+file_blank_lines = re.compile(r'\n\s*\n', re.MULTILINE)
+
+# the words of an upper cased line of g-code, comments are matched so that
+# their contents are skipped
+gcode_token = re.compile(r'\([^)]*\)?|;.*|([A-Z])\s*([-+]?\d*\.?\d*)')
+
+# the same words for the minimizer, kept in their case along with the
+# comments and spaces between them so it can tell nothing else is on a line
+minimizer_word = re.compile(
+    r'(\([^)]*\)?)|;.*|([A-Za-z])\s*([-+]?\d*\.?\d*)|\s+')
+message_comment = re.compile(r'\(\s*msg', re.IGNORECASE)
+
+# tinyg text mode prompt and acknowledgement
+tinyg_prompt = re.compile(r'^tinyg \[[^\]]+\] ok\>\s*')
+tinyg_acknowledgement = re.compile(r'^tinyg \[[^\]]+\] (ok|err)')
+
+# tinyg text mode config lines, tried in order
+#   ([\d\.\-\w]+)(.{0})                       2X2660-FHZ
+#   ([\d+\.]+) ((?:\[)[^\]]+(?:\]))         1 [standard]
+#   ([\d+\.]+) (\w+\/\w+(?:\^\d))           500000000.0 mm/min^3
+#   ([\d+\.]+) (\w{2,3}).*                  0.0100 mm (larger is faster)
+tinyg_config = [
+    re.compile(r'^\[([^\]]+)\] +([\w ]{0,10}[a-zA-Z ]+) ' + pattern + '$')
+    for pattern in [
+        r'([\d\.\-\w]+)(.{0})',
+        r'([\d+\.]+) (?:\[)([^\]]+)(?:\])',
+        r'([\d+\.]+) (\w+\/\w+(?:\^\d))',
+        r'([\d\-\.]+) (\w{2,3}).*']]
+
+sessions = {}
+
+
+def session(session_id):
+    # the echo back marker for a session, built once per session id
+    if session_id not in sessions:
+        sessions[session_id] = re.compile('_' + re.escape(session_id) + '_')
+
+    return sessions[session_id]
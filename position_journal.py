@@ -0,0 +1,78 @@
+import os
+import json
+import logging
+import tempfile
+import threading
+
+
+class PositionJournal(object):
+
+    """
+      last known machine positions, kept in memory while the machine moves
+      and written out to their own small file now and then rather than
+      rewriting the whole config file for every status report
+    """
+
+    def __init__(self, file_path='positions.json'):
+        self.logger = logging.getLogger(__name__)
+        self.file_path = file_path
+        self.positions = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        # held from taking a snapshot until it is renamed into place
+        self.write_lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.file_path) as f:
+                positions = json.load(f)
+        except (IOError, ValueError):
+            self.logger.debug('No position journal at ' + self.file_path)
+            return False
+
+        with self.lock:
+            self.positions = dict(
+                (str(axis_letter), float(position))
+                for axis_letter, position in positions.items())
+            self.dirty = False
+
+        return True
+
+    def record(self, axis_letter, position):
+        with self.lock:
+            if self.positions.get(axis_letter) != position:
+                self.positions[axis_letter] = position
+                self.dirty = True
+
+    def get(self, axis_letter):
+        return self.positions.get(axis_letter)
+
+    def flush(self):
+        # write beside the journal and rename over it, so a crash part way
+        # through leaves the previous positions intact, one flush at a time
+        # so an older snapshot is never renamed over a newer one
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty:
+                    return False
+                content = json.dumps(self.positions, sort_keys=True)
+                self.dirty = False
+
+            directory = os.path.dirname(os.path.abspath(self.file_path))
+            file_descriptor, temp_path = tempfile.mkstemp(
+                prefix='.positions', dir=directory)
+            try:
+                with os.fdopen(file_descriptor, 'w') as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(temp_path, self.file_path)
+            except (IOError, OSError):
+                self.logger.debug('Writing the position journal failed')
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                with self.lock:
+                    self.dirty = True
+                return False
+
+        return True
@@ -0,0 +1,556 @@
+import math
+import bisect
+import logging
+from array import array
+from collections import namedtuple
+from PyQt4 import QtCore
+import gcode
+import time_estimate
+
+# the modal state in force after a line, spindle holds the M code turning
+# it on (3 or 4) or 0 when it is off
+ModalState = namedtuple('ModalState', [
+    'motion', 'absolute', 'metric', 'plane', 'feed_rate',
+    'spindle', 'spindle_speed', 'tool', 'coolant'])
+
+initial_state = ModalState(
+    motion=None, absolute=True, metric=True, plane=17, feed_rate=None,
+    spindle=0, spindle_speed=None, tool=None, coolant=False)
+
+# the two arc axes, the linear axis and the arc centre offset words for
+# G17, G18 and G19
+planes = {
+    17: ('x', 'y', 'z', 'I', 'J'),
+    18: ('z', 'x', 'y', 'K', 'I'),
+    19: ('y', 'z', 'x', 'J', 'K')}
+
+# g codes taking axis words that are not moves of the tool
+non_motion_codes = [4, 10, 28, 30, 53, 92]
+
+axis_letters = ['x', 'y', 'z', 'a']
+
+# analyses made or loaded this session, by program cache key
+cache = {}
+
+# the flat columns of a ProgramAnalysis
+array_fields = [
+    'move_slots', 'move_lengths', 'move_directions', 'move_feed_rates',
+    'move_times']
+
+
+class ProgramAnalysis(object):
+
+    """
+      statistics of the commands sent for a file, distances and bounds are
+      in millimetres with the first move starting at the origin
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.command_slots = 0
+        self.motion_lines = 0
+        self.motion_counts = {0: 0, 1: 0, 2: 0, 3: 0}
+        self.bounds = {}
+        self.cut_distance = 0.0
+        self.rapid_distance = 0.0
+        self.feed_rates = []
+        self.tools = []
+        self.tool_changes = 0
+        self.spindle_changes = 0
+        self.command_bytes = 0
+        self.bytes_saved = 0
+        self.modal_lines = []
+        self.modal_states = []
+
+        # every move as flat columns, the planner slots counted up to the
+        # end of it, its length, its x, y and z direction and its feed rate
+        # with 0 for rapids and infinity when none was set, then the seconds
+        # from the start of the file to its end
+        self.move_slots = array('l')
+        self.move_lengths = array('d')
+        self.move_directions = array('d')
+        self.move_feed_rates = array('d')
+        self.move_times = None
+
+    def __getstate__(self):
+        # arrays pickle as lists of numbers, as bytes they take a fraction
+        # of the time to write to the program cache or pass between
+        # processes
+        state = dict(self.__dict__)
+        for name in array_fields:
+            if state[name] is not None:
+                state[name] = (state[name].typecode, state[name].tostring())
+
+        return state
+
+    def __setstate__(self, state):
+        for name in array_fields:
+            if state[name] is not None:
+                typecode, data = state[name]
+                state[name] = array(typecode)
+                state[name].fromstring(data)
+        self.__dict__.update(state)
+
+    def include(self, axis_letter, value):
+        if axis_letter not in self.bounds:
+            self.bounds[axis_letter] = [value, value]
+        elif value < self.bounds[axis_letter][0]:
+            self.bounds[axis_letter][0] = value
+        elif value > self.bounds[axis_letter][1]:
+            self.bounds[axis_letter][1] = value
+
+    def modal_state(self, line_number):
+        # the modal state in force after the given line, changes are only
+        # stored for the lines where something changed
+        index = bisect.bisect_right(self.modal_lines, line_number) - 1
+        if index < 0:
+            return initial_state
+
+        return self.modal_states[index]
+
+    def add_distances(self):
+        # summed from the moves once they are all in, so the totals do not
+        # depend on the order the moves were collected in
+        self.cut_distance = math.fsum(
+            length for length, feed_rate
+            in zip(self.move_lengths, self.move_feed_rates) if feed_rate != 0)
+        self.rapid_distance = math.fsum(
+            length for length, feed_rate
+            in zip(self.move_lengths, self.move_feed_rates) if feed_rate == 0)
+
+    def remaining_time(self, slots_executed):
+        # seconds left once the board has finished the given number of
+        # planner slots, moves are taken as done when all of their slots are
+        if self.move_times is None or len(self.move_times) == 0:
+            return None
+
+        index = bisect.bisect_right(self.move_slots, slots_executed)
+        if index >= len(self.move_times):
+            return 0.0
+        if index == 0:
+            return self.move_times[-1]
+
+        return self.move_times[-1] - self.move_times[index - 1]
+
+    def summary(self):
+        text = '%d lines, %d moves (G0 %d, G1 %d, G2 %d, G3 %d)\n' % (
+            self.lines, self.motion_lines, self.motion_counts[0],
+            self.motion_counts[1], self.motion_counts[2],
+            self.motion_counts[3])
+        text += 'cut %.1fmm, rapid %.1fmm\n' % (
+            self.cut_distance, self.rapid_distance)
+        for axis_letter in axis_letters:
+            if axis_letter in self.bounds:
+                text += '%s %.3f to %.3f\n' % (
+                    axis_letter.upper(), self.bounds[axis_letter][0],
+                    self.bounds[axis_letter][1])
+        text += 'feed rates: ' + ', '.join(
+            '%g' % feed_rate for feed_rate in self.feed_rates) + '\n'
+        text += '%d tool changes, %d spindle changes' % (
+            self.tool_changes, self.spindle_changes)
+        if self.bytes_saved > 0:
+            text += '\nrestricting precision saved %d bytes (%.1f%%)' % (
+                self.bytes_saved, 100.0 * self.bytes_saved /
+                (self.command_bytes + self.bytes_saved))
+
+        return text
+
+
+def arc_sweep(start_angle, end_angle, clockwise):
+    # the angle swept from start to end, an arc ending where it started is
+    # a full circle
+    if clockwise:
+        sweep = (start_angle - end_angle) % (2 * math.pi)
+    else:
+        sweep = (end_angle - start_angle) % (2 * math.pi)
+
+    if sweep < 1e-9:
+        sweep += 2 * math.pi
+
+    return sweep
+
+
+def arc_centre(start, end, words, offset_letters, clockwise, scale):
+    # centre of an arc from its I/J/K offsets or from its R radius
+    radii = words.get('R')
+    if not radii:
+        offsets = [words.get(letter) for letter in offset_letters]
+        return (
+            start[0] + (offsets[0][0] * scale if offsets[0] else 0.0),
+            start[1] + (offsets[1][0] * scale if offsets[1] else 0.0))
+
+    radius = abs(radii[0] * scale)
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    chord = math.hypot(dx, dy)
+    if chord == 0 or chord > 2 * radius + 1e-9:
+        return None
+
+    # positive radii take the short way round, the centre is to the left
+    # of the chord for counter clockwise arcs
+    height = math.sqrt(max(radius * radius - chord * chord / 4, 0.0))
+    side = 1 if (not clockwise) != (radii[0] < 0) else -1
+    return (
+        start[0] + dx / 2 - side * height * dy / chord,
+        start[1] + dy / 2 + side * height * dx / chord)
+
+
+def add_arc(analysis, start, end, words, state, scale):
+    first, second, linear, i_letter, j_letter = planes[state.plane]
+    clockwise = (state.motion == 2)
+    start_point = (start[first], start[second])
+    end_point = (end[first], end[second])
+
+    centre = arc_centre(
+        start_point, end_point, words, (i_letter, j_letter), clockwise,
+        scale)
+    if centre is None:
+        # not a valid arc, count it as the straight move it ends with
+        return math.sqrt(sum(
+            (end[axis_letter] - start[axis_letter]) ** 2
+            for axis_letter in ['x', 'y', 'z'])), None
+
+    radius = math.hypot(
+        start_point[0] - centre[0], start_point[1] - centre[1])
+    start_angle = math.atan2(
+        start_point[1] - centre[1], start_point[0] - centre[0])
+    end_angle = math.atan2(
+        end_point[1] - centre[1], end_point[0] - centre[0])
+    sweep = arc_sweep(start_angle, end_angle, clockwise)
+
+    # the arc reaches past its end points wherever it crosses an axis
+    for quarter in range(4):
+        angle = quarter * math.pi / 2
+        if clockwise:
+            offset = (start_angle - angle) % (2 * math.pi)
+        else:
+            offset = (angle - start_angle) % (2 * math.pi)
+        if offset <= sweep:
+            analysis.include(first, centre[0] + radius * math.cos(angle))
+            analysis.include(second, centre[1] + radius * math.sin(angle))
+
+    return math.hypot(radius * sweep, end[linear] - start[linear]), radius
+
+
+class ArcSlots(object):
+
+    """
+      the planner entries an arc of a radius and length at a feed rate is
+      expected to take up, plain values so it can be handed to the
+      preprocess pool
+    """
+
+    def __call__(self, radius, length, feed_rate):
+        return 4
+
+
+class ChordArcSlots(ArcSlots):
+
+    """
+      arcs the board cuts into chords that each take a planner entry, as
+      long as the chordal tolerance allows or 0.1mm without one and never
+      shorter than 10ms at the programmed feed rate
+    """
+
+    def __init__(self, tolerance=None):
+        self.tolerance = tolerance
+
+    def chord_length(self, radius):
+        if self.tolerance is None:
+            return 0.1
+
+        tolerance = min(self.tolerance, radius)
+        return 2 * math.sqrt(max(tolerance * (2 * radius - tolerance), 1e-9))
+
+    def __call__(self, radius, length, feed_rate):
+        segments = length / self.chord_length(radius)
+        if feed_rate:
+            segments = min(segments, length / feed_rate * 60 / 0.01)
+
+        return max(1, int(segments))
+
+
+def exact_add(partials, value):
+    # the running sum math.fsum keeps, partials add up to the exact total
+    # so incremental positions come out the same however they were summed
+    result = []
+    for partial in partials:
+        if abs(value) < abs(partial):
+            value, partial = partial, value
+        high = value + partial
+        low = partial - (high - value)
+        if low:
+            result.append(low)
+        value = high
+    result.append(value)
+
+    return result
+
+
+def next_state(state, words):
+    # the modal state in force after a line with the given words, the last
+    # word of a group on a line wins
+    changes = {}
+    for code in words.get('G', ()):
+        if code in (0, 1, 2, 3):
+            changes['motion'] = int(code)
+        elif code in (17, 18, 19):
+            changes['plane'] = int(code)
+        elif code in (20, 21):
+            changes['metric'] = (code == 21)
+        elif code in (90, 91):
+            changes['absolute'] = (code == 90)
+
+    for code in words.get('M', ()):
+        if code in (3, 4):
+            changes['spindle'] = int(code)
+        elif code == 5:
+            changes['spindle'] = 0
+        elif code in (7, 8):
+            changes['coolant'] = True
+        elif code == 9:
+            changes['coolant'] = False
+
+    if 'F' in words:
+        scale = 1.0 if changes.get('metric', state.metric) else 25.4
+        changes['feed_rate'] = words['F'][-1] * scale
+    if 'S' in words:
+        changes['spindle_speed'] = words['S'][-1]
+    if 'T' in words:
+        changes['tool'] = int(words['T'][-1])
+
+    if len(changes) == 0:
+        return state
+
+    return state._replace(**changes)
+
+
+def move_end(sums, words, state):
+    # the exact sums of the axis positions a line moves to, or None when it
+    # is not a move, a move is any line with axis words in a motion mode
+    if state.motion is None or \
+            any(code in non_motion_codes for code in words.get('G', ())):
+        return None
+
+    scale = 1.0 if state.metric else 25.4
+    end = None
+    for axis_letter in axis_letters:
+        values = words.get(axis_letter.upper())
+        if values:
+            if end is None:
+                end = dict(sums)
+            if state.absolute:
+                end[axis_letter] = [values[0] * scale]
+            else:
+                end[axis_letter] = exact_add(
+                    sums[axis_letter], values[0] * scale)
+
+    return end
+
+
+def initial_sums():
+    return dict((axis_letter, []) for axis_letter in axis_letters)
+
+
+def analyse(commands, command_slots, arc_slots, state=initial_state,
+            sums=None):
+    # one pass over the commands sent for a file, command_slots is the
+    # controller's count of planner slots for a line and its tokens and
+    # arc_slots its count for an arc of a radius and length at a feed rate,
+    # part of a file is analysed from the state and position sums the
+    # lines before it left
+    analysis = ProgramAnalysis()
+    if sums is None:
+        sums = initial_sums()
+    position = dict(
+        (axis_letter, math.fsum(sums[axis_letter]))
+        for axis_letter in axis_letters)
+    feed_rates = set()
+    tools = set()
+
+    for line_number, command in enumerate(commands):
+        analysis.lines += 1
+        analysis.command_bytes += len(command) + 1
+        tokens = gcode.tokenize(command)
+        if len(tokens) == 0:
+            analysis.command_slots += command_slots(command, tokens)
+            continue
+
+        words = gcode.words(tokens)
+        previous = state
+        state = next_state(state, words)
+
+        scale = 1.0 if state.metric else 25.4
+        analysis.tool_changes += words.get('M', []).count(6)
+        for feed_rate in words.get('F', ()):
+            feed_rates.add(feed_rate * scale)
+        for tool in words.get('T', ()):
+            tools.add(int(tool))
+
+        if (state.spindle, state.spindle_speed) != \
+                (previous.spindle, previous.spindle_speed):
+            analysis.spindle_changes += 1
+
+        if state != previous:
+            analysis.modal_lines.append(line_number)
+            analysis.modal_states.append(state)
+
+        end_sums = move_end(sums, words, state)
+        if end_sums is None:
+            analysis.command_slots += command_slots(command, tokens)
+            continue
+
+        end = dict(
+            (axis_letter, math.fsum(end_sums[axis_letter])
+             if end_sums[axis_letter] is not sums[axis_letter]
+             else position[axis_letter])
+            for axis_letter in axis_letters)
+
+        # every move takes a planner entry, arcs one for each of the chords
+        # the board cuts them into
+        analysis.motion_lines += 1
+        analysis.motion_counts[state.motion] += 1
+        if state.motion in (2, 3):
+            length, radius = add_arc(
+                analysis, position, end, words, state, scale)
+            if radius is None:
+                analysis.command_slots += 1
+            else:
+                analysis.command_slots += arc_slots(
+                    radius, length, state.feed_rate)
+        else:
+            analysis.command_slots += 1
+            length = math.sqrt(sum(
+                (end[axis_letter] - position[axis_letter]) ** 2
+                for axis_letter in ['x', 'y', 'z']))
+
+        # arcs are timed along the direction of their chord
+        chord = math.sqrt(sum(
+            (end[axis_letter] - position[axis_letter]) ** 2
+            for axis_letter in ['x', 'y', 'z']))
+        analysis.move_slots.append(analysis.command_slots)
+        analysis.move_lengths.append(length)
+        for axis_letter in ['x', 'y', 'z']:
+            analysis.move_directions.append(
+                (end[axis_letter] - position[axis_letter]) / chord
+                if chord > 0 else 0.0)
+        analysis.move_feed_rates.append(
+            0.0 if state.motion == 0 else (state.feed_rate or float('inf')))
+
+        for axis_letter in axis_letters:
+            if end[axis_letter] != position[axis_letter] or \
+                    axis_letter in analysis.bounds:
+                analysis.include(axis_letter, end[axis_letter])
+        position = end
+        sums = end_sums
+
+    analysis.feed_rates = sorted(feed_rates)
+    analysis.tools = sorted(tools)
+    analysis.add_distances()
+
+    return analysis
+
+
+def merge(analyses):
+    # one analysis from those of consecutive parts of a file, each made
+    # from the state and position the part before it ended with
+    merged = ProgramAnalysis()
+    feed_rates = set()
+    tools = set()
+    for analysis in analyses:
+        merged.modal_lines.extend(
+            line_number + merged.lines
+            for line_number in analysis.modal_lines)
+        merged.modal_states.extend(analysis.modal_states)
+        merged.move_slots.extend(
+            slots + merged.command_slots for slots in analysis.move_slots)
+        merged.move_lengths.extend(analysis.move_lengths)
+        merged.move_directions.extend(analysis.move_directions)
+        merged.move_feed_rates.extend(analysis.move_feed_rates)
+
+        merged.lines += analysis.lines
+        merged.command_bytes += analysis.command_bytes
+        merged.bytes_saved += analysis.bytes_saved
+        merged.command_slots += analysis.command_slots
+        merged.motion_lines += analysis.motion_lines
+        for motion, count in analysis.motion_counts.items():
+            merged.motion_counts[motion] += count
+        merged.tool_changes += analysis.tool_changes
+        merged.spindle_changes += analysis.spindle_changes
+        for axis_letter, (low, high) in analysis.bounds.items():
+            merged.include(axis_letter, low)
+            merged.include(axis_letter, high)
+        feed_rates.update(analysis.feed_rates)
+        tools.update(analysis.tools)
+
+    merged.feed_rates = sorted(feed_rates)
+    merged.tools = sorted(tools)
+    merged.add_distances()
+
+    return merged
+
+
+class Preflight(QtCore.QThread):
+    analysed = QtCore.pyqtSignal(object, object)
+    controller = None
+    limits = None
+    cache_writer = None
+    rewriter = None
+    settings = None
+    exit_loop = False
+
+    def __init__(self, file_path, key, commands, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.logger = logging.getLogger(__name__)
+        self.file_path = file_path
+        self.key = key
+        self.commands = commands
+
+    def exit(self):
+        self.exit_loop = True
+
+    def analyse(self):
+        # the commands are written to the program cache as they go past
+        def commands():
+            for command in self.commands:
+                if self.exit_loop:
+                    return
+                if self.cache_writer is not None:
+                    self.cache_writer.write(command)
+                yield command
+
+        analysis = analyse(
+            commands(), self.controller.command_slots,
+            self.controller.arc_slot_counter())
+        if self.rewriter is not None:
+            analysis.bytes_saved = self.rewriter.bytes_saved
+
+        return analysis
+
+    def run(self):
+        if self.key is None:
+            # the file is hashed here rather than where it was chosen
+            self.key = self.controller.preflight_key(self.file_path)
+            analysis = self.controller.cached_analysis(self.key)
+            if analysis is not None:
+                if not self.exit_loop:
+                    self.analysed.emit(self.file_path, analysis)
+                return
+
+        self.cache_writer = self.controller.program_cache.writer(self.key)
+        analysis = self.analyse()
+        if self.limits is not None and not self.exit_loop:
+            analysis.move_times = time_estimate.estimate(
+                analysis, self.limits)
+
+        if self.exit_loop:
+            self.logger.debug('Preflight exiting')
+            if self.cache_writer is not None:
+                self.cache_writer.abort()
+            return
+
+        cache[self.key] = analysis
+        if self.cache_writer is not None:
+            self.cache_writer.commit(analysis)
+        self.logger.debug('Analysed ' + self.file_path)
+        self.analysed.emit(self.file_path, analysis)
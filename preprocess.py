@@ -0,0 +1,301 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+import gcode
+import preflight
+from preflight import ModalState
+from configuration import conf
+
+# files smaller than this are analysed in one pass, starting the processes
+# would cost more than they save
+minimum_size = 4 << 20
+
+# every process gets a few chunks so one slow chunk does not hold up the
+# others at the end
+chunks_per_process = 4
+
+# a modal value none of the lines of a chunk set, it is whatever the chunk
+# before ended with
+inherited = 'inherited'
+
+# the processes files are preprocessed in, started by start_pool
+pool = None
+
+
+def configured_processes():
+    processes = conf.get('common.preprocess_processes')
+    if processes == 0:
+        try:
+            processes = multiprocessing.cpu_count()
+        except NotImplementedError:
+            processes = 1
+
+    return max(1, processes)
+
+
+def start_pool():
+    # the processes are forked while the application has only the one
+    # thread, forking once the listener, sender and scheduler threads are
+    # running could copy a lock one of them holds into a process that then
+    # waits on it forever, and python 2 has no way to start them other
+    # than forking
+    global pool
+    if pool is None and configured_processes() > 1:
+        pool = multiprocessing.Pool(configured_processes())
+
+    return pool
+
+
+def process_count(file_path):
+    # the number of processes to analyse a file with, 1 for a single pass,
+    # files are only split when the pool was started
+    if pool is None:
+        return 1
+
+    try:
+        if os.path.getsize(file_path) < minimum_size:
+            return 1
+    except OSError:
+        return 1
+
+    return configured_processes()
+
+
+def split_points(file_path, chunks):
+    # offsets of roughly equal chunks of a file, each starting at the
+    # start of a line, the last offset is the size of the file
+    size = os.path.getsize(file_path)
+    points = [0]
+    with open(file_path, 'rb') as f:
+        for chunk in range(1, chunks):
+            f.seek(max(size * chunk // chunks - 1, points[-1]))
+            f.readline()
+            if points[-1] < f.tell() < size:
+                points.append(f.tell())
+    points.append(size)
+
+    return points
+
+
+def chunk_lines(file_path, start, end):
+    # the lines between two split points, the same lines read_lines gives
+    # for that part of the file
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    lines = data.split(b'\n')
+    if data.endswith(b'\n'):
+        lines.pop()
+
+    return lines
+
+
+class ChunkSettings(object):
+
+    """
+      what the pool processes need from the controller to process and
+      analyse a chunk of a file, plain values sent along with every task
+    """
+
+    def __init__(self, controller):
+        self.word_decimals = dict(controller.word_decimals)
+        self.filter_file = bool(conf.get('common.filter_file_commands'))
+        self.restrict_precision = bool(
+            conf.get('common.restrict_file_precision'))
+        self.arc_slots = controller.arc_slot_counter()
+
+    def process_lines(self, lines, rewriter):
+        if not self.restrict_precision:
+            rewriter = None
+
+        return gcode.process_lines(lines, self.filter_file, rewriter)
+
+
+class ChunkTracker(object):
+
+    """
+      follows the modal state and position through the lines of a chunk
+      from an entry that may only be partly known, modal values that are
+      not set stay inherited and axes that are not moved to an absolute
+      position are summed relative to the entry, modes the chunk relied on
+      before setting them are noted so a wrong guess can be found
+    """
+
+    def __init__(self, state, sums):
+        self.state = state
+        self.sums = sums
+        self.assigned = set()
+        self.set_modes = set()
+        self.used_modes = set()
+
+    def line(self, words):
+        for code in words.get('G', ()):
+            if code in (0, 1, 2, 3):
+                self.set_modes.add('motion')
+            elif code in (20, 21):
+                self.set_modes.add('metric')
+            elif code in (90, 91):
+                self.set_modes.add('absolute')
+        if 'F' in words and 'metric' not in self.set_modes:
+            self.used_modes.add('metric')
+
+        self.state = preflight.next_state(self.state, words)
+        end = preflight.move_end(self.sums, words, self.state)
+        if end is None:
+            return
+
+        if len(self.set_modes) < 3:
+            self.used_modes.update(
+                mode for mode in ['absolute', 'metric', 'motion']
+                if mode not in self.set_modes)
+        if self.state.absolute:
+            for axis_letter in preflight.axis_letters:
+                if end[axis_letter] is not self.sums[axis_letter]:
+                    self.assigned.add(axis_letter)
+        self.sums = end
+
+
+def summarise_chunk(task):
+    # process the lines of a chunk into a file of commands and follow them
+    # in absolute distance mode in either unit, which covers the modes
+    # files are almost always in, other entry modes are only followed
+    # again if the chunk relies on them
+    settings, file_path, start, end, commands_path = task
+    trackers = {}
+    for metric in (True, False):
+        trackers[metric] = ChunkTracker(ModalState(
+            motion=inherited, absolute=True, metric=metric,
+            plane=inherited, feed_rate=inherited, spindle=inherited,
+            spindle_speed=inherited, tool=inherited, coolant=inherited),
+            preflight.initial_sums())
+
+    rewriter = gcode.NumberRewriter(settings.word_decimals)
+    lines = chunk_lines(file_path, start, end)
+    with open(commands_path, 'wb') as f:
+        for command in settings.process_lines(lines, rewriter):
+            f.write(command + '\n')
+            words = gcode.words(gcode.tokenize(command))
+            if len(words) > 0:
+                trackers[True].line(words)
+                trackers[False].line(words)
+
+    return trackers, rewriter.bytes_saved
+
+
+def analyse_chunk(task):
+    settings, commands_path, state, sums, bytes_saved = task
+    analysis = preflight.analyse(
+        gcode.read_lines(commands_path), gcode.command_slots,
+        settings.arc_slots, state, sums)
+    analysis.bytes_saved = bytes_saved
+
+    return analysis
+
+
+def resolve(state, sums, trackers, commands_path):
+    # the exact state and position sums a chunk ends with, given the ones
+    # it starts with
+    # either unit does when nothing depended on it
+    tracker = trackers[
+        state.metric or 'metric' not in trackers[True].used_modes]
+    if ('absolute' in tracker.used_modes and not state.absolute) or \
+            ('motion' in tracker.used_modes and state.motion is None):
+        # the chunk was followed from the wrong modes, follow it again
+        tracker = ChunkTracker(state, sums)
+        for command in gcode.read_lines(commands_path):
+            words = gcode.words(gcode.tokenize(command))
+            if len(words) > 0:
+                tracker.line(words)
+        return tracker.state, tracker.sums
+
+    end_state = ModalState(*[
+        entry if value == inherited else value
+        for value, entry in zip(tracker.state, state)])
+    end_state = end_state._replace(
+        absolute=end_state.absolute if 'absolute' in tracker.set_modes
+        else state.absolute,
+        metric=end_state.metric if 'metric' in tracker.set_modes
+        else state.metric)
+
+    resolved = {}
+    for axis_letter in preflight.axis_letters:
+        if axis_letter in tracker.assigned:
+            resolved[axis_letter] = tracker.sums[axis_letter]
+        else:
+            resolved[axis_letter] = sums[axis_letter]
+            for partial in tracker.sums[axis_letter]:
+                resolved[axis_letter] = preflight.exact_add(
+                    resolved[axis_letter], partial)
+
+    return end_state, resolved
+
+
+def preprocess(pool, settings, file_path, processes, directory,
+               stopped=None):
+    # process and analyse a file in chunks spread over a pool of processes,
+    # giving the analysis and the files holding the commands of each chunk
+    # in order, or None when stopped returns true part way through, chunks
+    # already handed out are left to finish and their results dropped
+    points = split_points(file_path, processes * chunks_per_process)
+    commands_paths = [
+        os.path.join(directory, '%d.gcode' % index)
+        for index in range(len(points) - 1)]
+
+    summaries = pool.imap(summarise_chunk, [
+        (settings, file_path, points[index], points[index + 1],
+         commands_path)
+        for index, commands_path in enumerate(commands_paths)])
+
+    # the modal state and position carried across each boundary are known
+    # as soon as the chunks before it are summarised, so each chunk is
+    # queued for analysis while later ones are still going
+    results = []
+    state = preflight.initial_state
+    sums = preflight.initial_sums()
+    for index, (trackers, bytes_saved) in enumerate(summaries):
+        if stopped is not None and stopped():
+            return None
+        results.append(pool.apply_async(analyse_chunk, [
+            (settings, commands_paths[index], state, sums, bytes_saved)]))
+        state, sums = resolve(state, sums, trackers, commands_paths[index])
+
+    analyses = []
+    for result in results:
+        if stopped is not None and stopped():
+            return None
+        analyses.append(result.get())
+
+    return preflight.merge(analyses), commands_paths
+
+
+class ParallelPreflight(preflight.Preflight):
+
+    """
+      the preflight of a large file in a pool of processes, with the same
+      analysis and cached commands as the single pass
+    """
+
+    processes = 2
+
+    def analyse(self):
+        directory = tempfile.mkdtemp(prefix='cender-preprocess-')
+        try:
+            result = preprocess(
+                pool, ChunkSettings(self.controller), self.file_path,
+                self.processes, directory, lambda: self.exit_loop)
+            if result is None:
+                return None
+
+            analysis, commands_paths = result
+            if self.cache_writer is not None:
+                for commands_path in commands_paths:
+                    self.cache_writer.write_file(commands_path)
+        finally:
+            shutil.rmtree(directory, True)
+
+        self.logger.debug(
+            'Preprocessed %s in %d processes' % (
+                self.file_path, self.processes))
+        return analysis
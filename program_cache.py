@@ -0,0 +1,160 @@
+import os
+import shutil
+import logging
+import hashlib
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# part of every key, change it whenever the processing of files or the
+# stored analysis changes so older entries are no longer found
+format_version = 5
+
+
+class ProgramCache(object):
+
+    """
+      the commands sent for a file and their preflight analysis kept on
+      disk, keyed by the contents of the file and the settings that change
+      what is sent, so a file run before needs no processing at all
+    """
+
+    max_entries = 50
+
+    def __init__(self, directory):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.keys = {}
+
+    def stat_key(self, file_path, settings):
+        stat = os.stat(file_path)
+        return (
+            os.path.realpath(file_path), stat.st_size, stat.st_mtime) + \
+            settings
+
+    def known_key(self, file_path, *settings):
+        # the key of a file hashed before and unchanged since, or None
+        try:
+            return self.keys.get(self.stat_key(file_path, settings))
+        except OSError:
+            return None
+
+    def key(self, file_path, *settings):
+        # hashing is skipped for a file unchanged since it was last hashed
+        stat_key = self.stat_key(file_path, settings)
+        if stat_key not in self.keys:
+            digest = hashlib.sha1()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            digest.update(repr((format_version,) + settings).encode('utf-8'))
+            self.keys[stat_key] = digest.hexdigest()
+
+        return self.keys[stat_key]
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def lines_path(self, key):
+        # an entry is only complete once its analysis has been written
+        if os.path.isfile(self.path(key, '.analysis')) and \
+                os.path.isfile(self.path(key, '.gcode')):
+            return self.path(key, '.gcode')
+
+        return None
+
+    def load(self, key):
+        if self.lines_path(key) is None:
+            return None
+
+        try:
+            with open(self.path(key, '.analysis'), 'rb') as f:
+                analysis = pickle.load(f)
+
+            # the newest entries are the ones kept when pruning
+            os.utime(self.path(key, '.analysis'), None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError):
+            self.logger.debug('Could not load cached program ' + key)
+            return None
+
+        return analysis
+
+    def writer(self, key):
+        try:
+            return ProgramCacheWriter(self, key)
+        except (IOError, OSError):
+            self.logger.debug('Program cache not writable at ' +
+                              self.directory)
+            return None
+
+    def prune(self):
+        try:
+            entries = sorted(
+                (os.path.getmtime(os.path.join(self.directory, name)), name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.analysis'))
+        except OSError:
+            return
+
+        stale = max(0, len(entries) - self.max_entries)
+        for modified, name in entries[:stale]:
+            key = name[:-len('.analysis')]
+            for extension in ['.analysis', '.gcode']:
+                try:
+                    os.remove(self.path(key, extension))
+                except OSError:
+                    pass
+
+
+class ProgramCacheWriter(object):
+
+    """
+      collects the commands of a file while they are processed, nothing is
+      visible in the cache until commit is called with the analysis
+    """
+
+    def __init__(self, cache, key):
+        self.logger = logging.getLogger(__name__)
+        self.cache = cache
+        self.key = key
+
+        if not os.path.isdir(cache.directory):
+            os.makedirs(cache.directory)
+        file_descriptor, self.temp_path = tempfile.mkstemp(
+            prefix='.' + key, dir=cache.directory)
+        self.file = os.fdopen(file_descriptor, 'wb')
+
+    def write(self, command):
+        self.file.write(command + '\n')
+
+    def write_file(self, file_path):
+        # commands already written out a line at a time elsewhere
+        with open(file_path, 'rb') as f:
+            shutil.copyfileobj(f, self.file)
+
+    def commit(self, analysis):
+        analysis_path = self.cache.path(self.key, '.analysis')
+        temp_analysis_path = analysis_path + '.tmp'
+        try:
+            self.file.close()
+            os.rename(self.temp_path, self.cache.path(self.key, '.gcode'))
+            with open(temp_analysis_path, 'wb') as f:
+                pickle.dump(analysis, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_analysis_path, analysis_path)
+        except (IOError, OSError, pickle.PicklingError):
+            self.logger.debug('Could not cache program ' + self.key)
+            for path in [self.temp_path, temp_analysis_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        self.cache.prune()
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
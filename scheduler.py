@@ -0,0 +1,123 @@
+import os
+import time
+import heapq
+import logging
+import threading
+from PyQt4 import QtCore
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    def monotonic():
+        # python 2 has no monotonic clock, the elapsed real time from
+        # os.times does not jump when the wall clock is changed
+        return os.times()[4]
+
+
+class ScheduledJob(object):
+
+    """
+      a callback the scheduler runs every interval seconds until it is
+      stopped, a paused job is left out of the schedule altogether, a one
+      shot job pauses itself after each run until it is resumed again
+    """
+
+    def __init__(self, scheduler, interval, callback, once=False):
+        self.scheduler = scheduler
+        self.interval = interval
+        self.callback = callback
+        self.once = once
+        self.paused = False
+        self.stopped = False
+        self.queued = False
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.scheduler.resume_job(self)
+
+    def stop(self):
+        self.stopped = True
+
+
+class Scheduler(QtCore.QThread):
+
+    """
+      one thread running all the periodic work, jobs wait in a heap ordered
+      by when they are next due so nothing is created per tick
+    """
+
+    exit_loop = False
+
+    def __init__(self, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.logger = logging.getLogger(__name__)
+        self.condition = threading.Condition()
+        self.jobs = []
+        self.sequence = 0
+
+    def add(self, interval, callback, paused=False, once=False):
+        job = ScheduledJob(self, interval, callback, once)
+        job.paused = paused
+        if not paused:
+            with self.condition:
+                self.queue_job(job, monotonic() + interval)
+                self.condition.notify()
+
+        return job
+
+    def queue_job(self, job, due):
+        # the sequence number keeps jobs due at the same time in the order
+        # they were queued
+        self.sequence += 1
+        job.queued = True
+        heapq.heappush(self.jobs, (due, self.sequence, job))
+
+    def resume_job(self, job):
+        with self.condition:
+            job.paused = False
+            if not job.queued and not job.stopped:
+                self.queue_job(job, monotonic() + job.interval)
+                self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.exit_loop = True
+            self.condition.notify()
+
+    def run(self):
+        self.condition.acquire()
+        try:
+            while not self.exit_loop:
+                if len(self.jobs) == 0:
+                    self.condition.wait()
+                    continue
+
+                due, sequence, job = self.jobs[0]
+                now = monotonic()
+                if due > now:
+                    self.condition.wait(due - now)
+                    continue
+
+                heapq.heappop(self.jobs)
+                job.queued = False
+                if job.stopped or job.paused:
+                    continue
+
+                # due an interval after the last run was due rather than
+                # after it finished, so the ticks do not drift
+                if job.once:
+                    job.paused = True
+                else:
+                    self.queue_job(job, max(due + job.interval, now))
+
+                self.condition.release()
+                try:
+                    job.callback()
+                except Exception:
+                    self.logger.exception('Scheduled job failed')
+                finally:
+                    self.condition.acquire()
+        finally:
+            self.condition.release()
@@ -0,0 +1,148 @@
+import math
+from array import array
+
+# a model of a jerk limited motion planner in the style of tinyg's, moves
+# accelerate and decelerate along s-curves between cruise and the corner
+# velocities their junctions allow, velocities are in mm/min, jerk in
+# mm/min^3 and junction acceleration in mm/min^2
+
+axis_letters = ['x', 'y', 'z']
+
+
+def transition_length(start_velocity, end_velocity, jerk):
+    # distance taken to change velocity along a constant jerk s-curve
+    return (start_velocity + end_velocity) * \
+        math.sqrt(abs(end_velocity - start_velocity) / jerk)
+
+
+def transition_time(start_velocity, end_velocity, jerk):
+    return 2 * math.sqrt(abs(end_velocity - start_velocity) / jerk)
+
+
+def reachable_velocity(start_velocity, length, jerk):
+    # the firmware's estimate of how fast a move can get over its length
+    return start_velocity + math.pow(length, 2.0 / 3) * \
+        math.pow(jerk, 1.0 / 3)
+
+
+def junction_velocity(previous_direction, direction, limits):
+    # the fastest a corner can be taken while staying within the junction
+    # deviation of it at the junction acceleration
+    cos_theta = -sum(
+        previous_direction[axis] * direction[axis] for axis in range(3))
+    if cos_theta < -0.99:
+        # carrying on in a straight line
+        return float('inf')
+    if cos_theta > 0.99:
+        # turning straight back
+        return 0.0
+
+    deviation = sum(
+        limits['junction_deviation'][axis_letter] *
+        (previous_direction[axis] ** 2 + direction[axis] ** 2)
+        for axis, axis_letter in enumerate(axis_letters)) / 2
+    sin_theta_over_2 = math.sqrt((1 - cos_theta) / 2)
+    radius = deviation * sin_theta_over_2 / (1 - sin_theta_over_2)
+
+    return math.sqrt(radius * limits['junction_acceleration'])
+
+
+def axis_limit(per_axis, direction):
+    # the velocity along a direction at which the first axis reaches its
+    # own limit
+    limit = float('inf')
+    for axis, axis_letter in enumerate(axis_letters):
+        if direction[axis] != 0:
+            limit = min(limit, per_axis[axis_letter] / abs(direction[axis]))
+
+    return limit
+
+
+def move_time(length, entry_velocity, cruise_velocity, exit_velocity, jerk):
+    head = transition_length(entry_velocity, cruise_velocity, jerk)
+    tail = transition_length(cruise_velocity, exit_velocity, jerk)
+    if head + tail > length:
+        # too short to reach cruise, find the peak velocity it does reach
+        low = max(entry_velocity, exit_velocity)
+        high = cruise_velocity
+        for iteration in range(20):
+            middle = (low + high) / 2
+            if transition_length(entry_velocity, middle, jerk) + \
+                    transition_length(middle, exit_velocity, jerk) > length:
+                high = middle
+            else:
+                low = middle
+        cruise_velocity = low
+        head = transition_length(entry_velocity, cruise_velocity, jerk)
+        tail = transition_length(cruise_velocity, exit_velocity, jerk)
+
+    if cruise_velocity <= 0:
+        return 0.0
+
+    return transition_time(entry_velocity, cruise_velocity, jerk) + \
+        max(0.0, length - head - tail) / cruise_velocity + \
+        transition_time(cruise_velocity, exit_velocity, jerk)
+
+
+def estimate(analysis, limits):
+    # seconds from the start of the file to the end of each of its moves,
+    # limits holds per axis velocity, feed, jerk and junction_deviation
+    # dictionaries and the board's junction_acceleration
+    count = len(analysis.move_lengths)
+    cruise = array('d', [0.0]) * count
+    jerk = array('d', [0.0]) * count
+    junction = array('d', [0.0]) * count
+
+    previous_direction = None
+    for index in range(count):
+        direction = analysis.move_directions[index * 3:index * 3 + 3]
+        feed_rate = analysis.move_feed_rates[index]
+        if feed_rate == 0:
+            cruise[index] = axis_limit(limits['velocity'], direction)
+        else:
+            cruise[index] = min(
+                feed_rate, axis_limit(limits['feed'], direction))
+        jerk[index] = axis_limit(limits['jerk'], direction)
+        if math.isinf(jerk[index]):
+            jerk[index] = min(limits['jerk'].values())
+
+        # the machine starts from rest, corners are no faster than either
+        # of the moves either side of them
+        if previous_direction is not None:
+            junction[index] = min(
+                junction_velocity(previous_direction, direction, limits),
+                cruise[index - 1], cruise[index])
+        previous_direction = direction
+
+    # backwards, the fastest each move can be entered while still slowing
+    # in time for everything after it, the file ends at rest
+    entry = array('d', [0.0]) * count
+    following = 0.0
+    for index in range(count - 1, -1, -1):
+        entry[index] = min(
+            junction[index],
+            reachable_velocity(
+                following, analysis.move_lengths[index], jerk[index]))
+        following = entry[index]
+
+    # forwards, moves can only be entered as fast as the one before them
+    # could accelerate to
+    times = array('d', [0.0]) * count
+    total = 0.0
+    velocity = 0.0
+    for index in range(count):
+        length = analysis.move_lengths[index]
+        entry_velocity = min(entry[index], velocity)
+        exit_velocity = min(
+            entry[index + 1] if index + 1 < count else 0.0,
+            reachable_velocity(entry_velocity, length, jerk[index]),
+            cruise[index])
+        if length > 0:
+            total += move_time(
+                length, entry_velocity,
+                max(cruise[index], entry_velocity, exit_velocity),
+                exit_velocity, jerk[index]) * 60
+        times[index] = total
+        velocity = exit_velocity
+
+    return times